@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Multi-agent test for the lease API
+Starts a server with no local scheduler workers, several standalone agents
+(python -m job_server.agent) and a fake npx that sleeps instead of running
+Playwright. One agent is killed mid-run; its lease must expire and its group
+must be finished by the others.
+"""
+import os
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import requests
+
+PORT = 8765
+SERVER_URL = f"http://127.0.0.1:{PORT}"
+AGENTS = 3
+GROUPS = 6
+JOBS_PER_GROUP = 2
+
+FAKE_NPX = """#!/usr/bin/env python3
+import sys, time
+time.sleep(1)
+print("fake playwright run:", sys.argv[1:])
+"""
+
+def wait_for_server():
+    for _ in range(50):
+        try:
+            if requests.get(f"{SERVER_URL}/debug/groups").status_code == 200:
+                return True
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.2)
+    return False
+
+def main():
+    print("🧪 Agent Lease Test")
+    print("=" * 40)
+    tmp = tempfile.mkdtemp()
+    npx = os.path.join(tmp, "npx")
+    with open(npx, "w") as f:
+        f.write(FAKE_NPX)
+    os.chmod(npx, os.stat(npx).st_mode | stat.S_IEXEC)
+
+    env = {
+        **os.environ,
+        "QGJOB_SCHEDULER_WORKERS": "0",
+        "QGJOB_STORE": "memory",
+        "QGJOB_LEASE_TIMEOUT": "3",
+        "QGJOB_NPX_PATH": npx,
+        "QGJOB_LOG_DIR": tmp,
+    }
+    server = subprocess.Popen([
+        sys.executable, "-c",
+        f"import uvicorn; uvicorn.run('job_server.main:app', host='127.0.0.1', port={PORT}, log_level='warning')"
+    ], env=env)
+    agents = []
+    try:
+        if not wait_for_server():
+            print("❌ Server failed to start")
+            return
+        for i in range(AGENTS):
+            agents.append(subprocess.Popen([
+                sys.executable, "-m", "job_server.agent", "--server", SERVER_URL, "--agent-id", f"agent-{i}", "--wait", "2"
+            ], env=env))
+
+        jobs = [{
+            "org_id": "test_org",
+            "app_version_id": f"app_v{g}",
+            "test_path": "tests/onboarding.spec.js",
+            "target": "emulator"
+        } for g in range(GROUPS) for _ in range(JOBS_PER_GROUP)]
+        job_ids = requests.post(f"{SERVER_URL}/jobs:batch", json=jobs).json()["job_ids"]
+        print(f"✅ Submitted {len(job_ids)} jobs in {GROUPS} groups to {AGENTS} agents")
+
+        # Give the agents time to start and lease their first groups
+        time.sleep(2)
+        agents[0].send_signal(signal.SIGKILL)
+        print("💥 Killed agent-0 mid-run")
+
+        start = time.time()
+        while time.time() - start < 60:
+            statuses = [requests.get(f"{SERVER_URL}/jobs/{job_id}").json()["status"] for job_id in job_ids]
+            done = statuses.count("completed")
+            print(f"📈 {done}/{len(job_ids)} completed")
+            if done == len(job_ids):
+                print(f"✅ All jobs completed in {time.time() - start:.1f}s despite the lost agent")
+                break
+            time.sleep(1)
+        else:
+            print("❌ Jobs did not all complete")
+    finally:
+        for process in agents + [server]:
+            process.kill()
+
+if __name__ == "__main__":
+    main()
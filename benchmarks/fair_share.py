@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Benchmark queue wait for a small tenant while a big tenant floods the queue.
+
+A big org submits a burst of jobs, then a small org trickles jobs in. Each job
+runs for a fixed time on a simulated runner. Reports queue-wait percentiles for
+the small org with and without fair sharing. "Without" puts every job in the
+same org, which is how the scheduler behaved before per-org fair share.
+Run from the repository root:
+
+    python -m benchmarks.fair_share
+"""
+import argparse
+import statistics
+import time
+from job_server import queue, scheduler
+from job_server.models import JobPayload
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def run(args, fair):
+    queue.reset_queue()
+    queue.TARGET_SLOTS["emulator"] = args.slots
+    started = {}
+
+    def run_group(group_key, jobs):
+        for job_id, _ in jobs:
+            started[job_id] = time.perf_counter()
+            queue.update_job_status(job_id, "running")
+            time.sleep(args.job_seconds)
+            queue.update_job_status(job_id, "completed")
+
+    scheduler.run_group = run_group
+    scheduler.start_scheduler(args.slots)
+    big_org = "big"
+    small_org = "small" if fair else "big"
+    queue.enqueue_jobs([
+        JobPayload(org_id=big_org, app_version_id=f"big_{i}", test_path="t", target="emulator")
+        for i in range(args.big_jobs)
+    ])
+    submitted = {}
+    for i in range(args.small_jobs):
+        time.sleep(args.small_interval)
+        job_id = queue.enqueue_job(JobPayload(org_id=small_org, app_version_id=f"small_{i}", test_path="t", target="emulator"))
+        submitted[job_id] = time.perf_counter()
+    while any(job_id not in started for job_id in submitted):
+        time.sleep(0.01)
+    scheduler.stop_scheduler()
+    return [started[job_id] - submitted[job_id] for job_id in submitted]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--big-jobs", type=int, default=500)
+    parser.add_argument("--small-jobs", type=int, default=20)
+    parser.add_argument("--small-interval", type=float, default=0.02)
+    parser.add_argument("--job-seconds", type=float, default=0.01)
+    parser.add_argument("--slots", type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"big org: {args.big_jobs} jobs at once; small org: {args.small_jobs} jobs, one every {args.small_interval}s")
+    print(f"{'mode':<14} {'p50 wait':>10} {'p99 wait':>10}")
+    for fair in (False, True):
+        waits = run(args, fair)
+        print(f"{'fair share' if fair else 'single queue':<14} {statistics.median(waits):>9.3f}s {percentile(waits, 0.99):>9.3f}s")
+
+if __name__ == "__main__":
+    main()
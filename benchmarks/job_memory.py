@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Benchmark memory retained per finished job.
+
+Compares the original representation (a pydantic JobStatus holding its result
+for every job) against the compact JobRecord table, with results kept in memory
+(QGJOB_STORE=memory) and served from SQLite. Run from the repository root:
+
+    python -m benchmarks.job_memory
+"""
+import argparse
+import gc
+import os
+import tempfile
+import tracemalloc
+import uuid
+from job_server import queue
+from job_server.models import JobPayload, JobStatus
+from job_server.store import MemoryStore, SQLiteStore
+
+def fake_result(i, output_bytes):
+    return {
+        "stdout": f"{i}:" + "." * output_bytes,
+        "stderr": "",
+        "exit_code": 0,
+        "log_path": f"job_logs/{i}.log",
+    }
+
+def measure(fill):
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+    keep = fill()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    del keep
+    return retained
+
+def legacy_table(jobs, output_bytes):
+    # How jobs_status looked before: one pydantic model per job, result inline
+    table = {}
+    for i in range(jobs):
+        job_id = str(uuid.uuid4())
+        table[job_id] = JobStatus(
+            job_id=job_id,
+            status="completed",
+            message=f"Job {job_id} finished with exit code 0.",
+            result=fake_result(i, output_bytes),
+        )
+    return table
+
+def compact_table(jobs, output_bytes):
+    job = JobPayload(org_id="bench", app_version_id="app", test_path="tests/onboarding.spec.js", target="emulator")
+    job_ids = queue.enqueue_jobs([job] * jobs)
+    group_key, _ = queue.get_next_group()
+    queue.remove_group(group_key)
+    for i, job_id in enumerate(job_ids):
+        queue.update_job_status(job_id, "running")
+        queue.update_job_status(job_id, "completed", message=f"Job {job_id} finished with exit code 0.",
+                                result=fake_result(i, output_bytes))
+    queue.store.flush()
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=5000)
+    parser.add_argument("--output-bytes", type=int, default=2048, help="stdout kept per job result")
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    print(f"{args.jobs} finished jobs, {args.output_bytes} bytes of output each")
+    print(f"{'representation':<32} {'bytes/job':>10}")
+
+    retained = measure(lambda: legacy_table(args.jobs, args.output_bytes))
+    print(f"{'JobStatus dict (before)':<32} {retained / args.jobs:>10.0f}")
+
+    queue.RETAIN_FINISHED_JOBS = args.jobs
+    queue.reset_queue()
+    queue.store = MemoryStore()
+    retained = measure(lambda: compact_table(args.jobs, args.output_bytes))
+    print(f"{'JobRecord + results in memory':<32} {retained / args.jobs:>10.0f}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        queue.reset_queue()
+        queue.store = SQLiteStore(os.path.join(tmp, "bench.db"))
+        retained = measure(lambda: compact_table(args.jobs, args.output_bytes))
+        print(f"{'JobRecord + results in SQLite':<32} {retained / args.jobs:>10.0f}")
+        queue.store.close()
+
+    queue.RETAIN_FINISHED_JOBS = args.jobs // 10
+    queue.reset_queue()
+    queue.store = MemoryStore()
+    compact_table(args.jobs, args.output_bytes)
+    print(f"\nWith QGJOB_RETAIN_FINISHED_JOBS={queue.RETAIN_FINISHED_JOBS}: "
+          f"{len(queue.jobs_status)} of {args.jobs} jobs retained in memory")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Load-test the API, queue and scheduler with a simulated runner.
+
+A load generator drives POST /jobs at a target rate through the real FastAPI
+app (in-process, so no live server is needed). agent.run_group is swapped for
+a fake executor that sleeps and fails according to configurable distributions,
+so no Node/Playwright install is needed either. Reports submit rate, throughput,
+queue-wait percentiles, makespan and memory, so scheduler changes can be compared
+against each other. Run from the repository root:
+
+    python -m benchmarks.load --jobs 10000 --rate 500 --duration exp:0.01
+    python -m benchmarks.load --policy fifo,sjf,lpt --duration lognormal:0.005,1.5
+
+--duration is the distribution of typical run times across test paths, given as a
+number of seconds or one of fixed:S, uniform:LOW,HIGH, exp:MEAN and
+lognormal:MEDIAN,SIGMA. Each test path keeps its typical run time, give or take
+--jitter, so the dispatch policies have a history to learn from. The store
+defaults to memory here; set QGJOB_STORE=sqlite to include persistence.
+"""
+import argparse
+import itertools
+import math
+import os
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from typing import Callable
+
+os.environ.setdefault("QGJOB_STORE", "memory")
+
+from fastapi.testclient import TestClient
+from job_server import durations, queue, scheduler
+from job_server.main import app
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+Distribution = Callable[[random.Random], float]
+
+def parse_distribution(spec: str) -> Distribution:
+    kind, _, params = spec.partition(":")
+    if not params:
+        seconds = float(kind)
+        return lambda rng: seconds
+    values = [float(value) for value in params.split(",")]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda rng: rng.expovariate(1 / values[0])
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown distribution {spec!r}")
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+class FakeExecutor:
+    """Drop-in for agent.run_group: sleeps for each test path's run time and fails some of the jobs"""
+
+    def __init__(self, duration: Distribution, fail_rate: float = 0.0, seed: int = 0, jitter: float = 0.1):
+        self.duration = duration
+        self.fail_rate = fail_rate
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.test_seconds = {}
+        self.waits = []
+        self.finished = 0
+        self.failed = 0
+        self.last_finished_at = 0.0
+        self.expected = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, group_key, jobs, report=queue.update_job_status):
+        for job_id, job in jobs:
+            wait = time.time() - queue.jobs_status[job_id].submitted_at
+            report(job_id, "running")
+            with self._lock:
+                if job.test_path not in self.test_seconds:
+                    self.test_seconds[job.test_path] = self.duration(self.rng)
+                seconds = self.test_seconds[job.test_path] * self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+                failed = self.rng.random() < self.fail_rate
+            time.sleep(seconds)
+            durations.record(job, seconds)
+            report(job_id, "failed" if failed else "completed", result={"exit_code": int(failed)})
+            with self._lock:
+                self.waits.append(wait)
+                self.finished += 1
+                self.failed += failed
+                self.last_finished_at = time.perf_counter()
+                if self.finished == self.expected:
+                    self.done.set()
+
+def generate_load(client: TestClient, args) -> float:
+    """POST args.jobs jobs at args.rate per second from args.clients threads; returns the submit time"""
+    rng = random.Random(args.seed)
+    targets = args.targets.split(",")
+    payloads = [{
+        "org_id": f"org_{rng.randrange(args.orgs)}",
+        "app_version_id": f"app_{rng.randrange(args.app_versions)}",
+        "test_path": f"tests/spec_{rng.randrange(args.test_paths)}.spec.js",
+        "target": rng.choice(targets),
+        "priority": rng.randint(1, 3),
+    } for _ in range(args.jobs)]
+    counter = itertools.count()
+    start = time.perf_counter()
+
+    def sender():
+        while True:
+            i = next(counter)
+            if i >= len(payloads):
+                return
+            # Pace against the schedule rather than the previous request, so slow calls catch up
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            client.post("/jobs", json=payloads[i]).raise_for_status()
+
+    threads = [threading.Thread(target=sender) for _ in range(args.clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+def run(args, policy):
+    queue.reset_queue()
+    durations.reset()
+    queue.DISPATCH_POLICY = policy
+    for target in args.targets.split(","):
+        queue.TARGET_SLOTS[target] = args.slots
+    scheduler.SCHEDULER_WORKERS = args.slots * len(args.targets.split(","))
+    executor = FakeExecutor(parse_distribution(args.duration), args.fail_rate, args.seed, args.jitter)
+    executor.expected = args.jobs
+    scheduler.run_group = executor
+
+    if args.trace_memory:
+        tracemalloc.start()
+    with TestClient(app) as client:
+        start = time.perf_counter()
+        submit_seconds = generate_load(client, args)
+        finished = executor.done.wait(args.timeout)
+        scheduler.stop_scheduler()
+    if args.trace_memory:
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    if not finished:
+        print(f"⚠️  Only {executor.finished} of {args.jobs} jobs finished within {args.timeout}s")
+    elapsed = executor.last_finished_at - start
+    waits = executor.waits
+    print(f"policy:      {policy}")
+    print(f"submitted:   {args.jobs} jobs in {submit_seconds:.2f}s ({args.jobs / submit_seconds:.0f}/s, target {args.rate:.0f}/s)")
+    print(f"throughput:  {executor.finished / elapsed:.0f} jobs/s over {elapsed:.2f}s ({executor.failed} failed)")
+    print(f"makespan:    {elapsed:.2f}s")
+    print(f"queue wait:  mean {statistics.mean(waits) * 1000:.1f} ms  p50 {statistics.median(waits) * 1000:.1f} ms  p90 {percentile(waits, 0.9) * 1000:.1f} ms  "
+          f"p99 {percentile(waits, 0.99) * 1000:.1f} ms  max {max(waits) * 1000:.1f} ms")
+    if args.trace_memory:
+        print(f"memory:      {peak_bytes / 2**20:.1f} MiB peak traced allocations")
+    if resource is not None:
+        print(f"memory:      {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB max RSS")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=10000)
+    parser.add_argument("--rate", type=float, default=500, help="POST /jobs per second")
+    parser.add_argument("--clients", type=int, default=4, help="concurrent submitting threads")
+    parser.add_argument("--duration", default="exp:0.005", help="distribution of run times across test paths")
+    parser.add_argument("--jitter", type=float, default=0.1, help="run-to-run variation of a test path's run time")
+    parser.add_argument("--fail-rate", type=float, default=0.05)
+    parser.add_argument("--targets", default="emulator,device")
+    parser.add_argument("--slots", type=int, default=8, help="slots per target")
+    parser.add_argument("--orgs", type=int, default=4)
+    parser.add_argument("--app-versions", type=int, default=200)
+    parser.add_argument("--test-paths", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--trace-memory", action="store_true", help="report peak Python allocations (slower)")
+    parser.add_argument("--policy", default=queue.DISPATCH_POLICY, help="comma-separated dispatch policies to compare")
+    args = parser.parse_args()
+    for i, policy in enumerate(args.policy.split(",")):
+        if i:
+            print()
+        run(args, policy)
+
+if __name__ == "__main__":
+    main()
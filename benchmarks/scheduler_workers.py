@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Benchmark scheduler throughput (jobs/sec) for different worker counts.
+
+agent.run_group is replaced by a runner that sleeps for every job, so no
+Node/Playwright install is needed. Run from the repository root:
+
+    python -m benchmarks.scheduler_workers
+"""
+import argparse
+import time
+from job_server import queue, scheduler
+from job_server.models import JobPayload
+
+def fake_run_group(job_seconds):
+    def run_group(group_key, jobs):
+        for job_id, job in jobs:
+            queue.update_job_status(job_id, "running")
+            time.sleep(job_seconds)
+            queue.update_job_status(job_id, "completed")
+    return run_group
+
+def run(workers, groups, jobs_per_group, job_seconds):
+    queue.reset_queue()
+    # Give the target a slot per worker so only the worker count limits concurrency
+    queue.TARGET_SLOTS["emulator"] = workers
+    scheduler.run_group = fake_run_group(job_seconds)
+    job_ids = []
+    for g in range(groups):
+        for _ in range(jobs_per_group):
+            job_ids.append(queue.enqueue_job(JobPayload(
+                org_id="bench",
+                app_version_id=f"app_{g}",
+                test_path="tests/onboarding.spec.js",
+                target="emulator",
+            )))
+
+    start = time.perf_counter()
+    scheduler.start_scheduler(workers)
+    while any(queue.jobs_status[j].status != "completed" for j in job_ids):
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    scheduler.stop_scheduler()
+    return len(job_ids) / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, default=16)
+    parser.add_argument("--jobs-per-group", type=int, default=4)
+    parser.add_argument("--job-seconds", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    print(f"{args.groups} groups x {args.jobs_per_group} jobs, {args.job_seconds}s per job")
+    print(f"{'workers':>8} {'jobs/sec':>10} {'speedup':>8}")
+    baseline = None
+    for workers in args.workers:
+        rate = run(workers, args.groups, args.jobs_per_group, args.job_seconds)
+        baseline = baseline or rate
+        print(f"{workers:>8} {rate:>10.1f} {rate / baseline:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Benchmark GET /jobs/{job_id} throughput for different numbers of API worker processes.
+
+For each worker count a real server is started (job_server.serve --workers N) over a
+fresh SQLite store, with no scheduler workers so the jobs stay put. A batch of jobs is
+submitted, then client processes read random job statuses as fast as they can for a
+while. The primary serves reads from memory and the other workers from the shared
+database (see job_server/cluster.py). Clients compete with the server for CPU, so give
+the machine enough cores for both. Run from the repository root:
+
+    python -m benchmarks.status_reads --workers 1,2,4
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import requests
+
+def wait_until_up(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{url}/jobs", params={"limit": 1}, timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not come up")
+
+def reader(url, job_ids, seconds, seed, results):
+    # One client process: sequential GETs on a keep-alive connection
+    rng = random.Random(seed)
+    session = requests.Session()
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + seconds
+    while True:
+        started = time.perf_counter()
+        if started >= deadline:
+            break
+        response = session.get(f"{url}/jobs/{rng.choice(job_ids)}")
+        latencies.append(time.perf_counter() - started)
+        errors += not response.ok
+    results.put((latencies, errors))
+
+def run(workers: int, args):
+    port = args.port
+    url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            **os.environ,
+            "QGJOB_STORE": "sqlite",
+            "QGJOB_DB_PATH": os.path.join(tmp, "qgjob.db"),
+            "QGJOB_SCHEDULER_WORKERS": "0",
+            "QGJOB_PRIMARY_PORT": str(args.primary_port),
+        }
+        server = subprocess.Popen(
+            [sys.executable, "-m", "job_server.serve", "--host", "127.0.0.1", "--port", str(port),
+             "--workers", str(workers), "--log-level", "warning"],
+            env=env,
+        )
+        try:
+            wait_until_up(url)
+            payloads = [{"org_id": "bench", "app_version_id": f"app_{i % 50}", "test_path": f"tests/spec_{i}.spec.js",
+                         "target": "emulator"} for i in range(args.jobs)]
+            job_ids = requests.post(f"{url}/jobs:batch", json=payloads).json()["job_ids"]
+            # Let the store commit them so every worker can see them
+            time.sleep(0.5)
+
+            results = multiprocessing.Queue()
+            clients = [multiprocessing.Process(target=reader, args=(url, job_ids, args.seconds, i, results))
+                       for i in range(args.clients)]
+            for client in clients:
+                client.start()
+            collected = [results.get() for _ in clients]
+            for client in clients:
+                client.join()
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies = sorted(latency for client_latencies, _ in collected for latency in client_latencies)
+    errors = sum(client_errors for _, client_errors in collected)
+    print(f"{workers:>7}  {len(latencies) / args.seconds:>8.0f}  {statistics.median(latencies) * 1000:>8.2f}  "
+          f"{latencies[int(len(latencies) * 0.99)] * 1000:>8.2f}  {errors:>6}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated API worker counts")
+    parser.add_argument("--clients", type=int, default=8, help="reading client processes")
+    parser.add_argument("--seconds", type=float, default=5, help="how long the clients read for")
+    parser.add_argument("--jobs", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=8200)
+    parser.add_argument("--primary-port", type=int, default=8201)
+    args = parser.parse_args()
+    print(f"{os.cpu_count()} CPUs, {args.clients} client processes, {args.seconds:.0f}s per run")
+    print("workers     req/s  p50 (ms)  p99 (ms)  errors")
+    for workers in map(int, args.workers.split(",")):
+        run(workers, args)
+
+if __name__ == "__main__":
+    main()
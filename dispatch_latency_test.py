@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Latency test for scheduler dispatch
+Measures the gap between sending POST /jobs and the job switching to "running",
+and the CPU used by an idle server. Runs the API in-process with a stubbed runner,
+so neither a live server nor Playwright is needed.
+"""
+import os
+import statistics
+import time
+
+os.environ.setdefault("QGJOB_STORE", "memory")
+
+from fastapi.testclient import TestClient
+from job_server import queue, scheduler
+from job_server.main import app
+
+SAMPLES = 200
+
+running_at = {}
+
+def stub_run_group(group_key, jobs):
+    """Mark each job running, record when, and complete it immediately"""
+    for job_id, job in jobs:
+        queue.update_job_status(job_id, "running")
+        running_at[job_id] = time.perf_counter()
+        queue.update_job_status(job_id, "completed")
+
+def main():
+    print("⏱️  Dispatch Latency Test")
+    print("=" * 40)
+    scheduler.run_group = stub_run_group
+
+    with TestClient(app) as client:
+        time.sleep(0.2)  # let the scheduler workers block on the queue
+
+        cpu_start = time.process_time()
+        time.sleep(2)
+        idle_cpu = time.process_time() - cpu_start
+        print(f"💤 CPU used while idle for 2s: {idle_cpu * 1000:.1f} ms")
+
+        latencies = []
+        for i in range(SAMPLES):
+            submitted_at = time.perf_counter()
+            response = client.post("/jobs", json={
+                "org_id": "test_org",
+                "app_version_id": f"app_{i}",
+                "test_path": "tests/onboarding.spec.js",
+                "target": "emulator"
+            })
+            job_id = response.json()["job_id"]
+            while job_id not in running_at:
+                time.sleep(0)
+            latencies.append((running_at[job_id] - submitted_at) * 1000)
+
+        scheduler.stop_scheduler()
+
+    latencies.sort()
+    print(f"📈 POST /jobs -> running over {SAMPLES} jobs:")
+    print(f"  p50: {statistics.median(latencies):.3f} ms")
+    print(f"  p99: {latencies[int(len(latencies) * 0.99) - 1]:.3f} ms")
+    print(f"  max: {latencies[-1]:.3f} ms")
+
+if __name__ == "__main__":
+    main()
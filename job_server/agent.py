@@ -1,38 +1,286 @@
+import argparse
+import os
+import socket
+import threading
 import time
-import subprocess
+import requests
+from job_server import artifacts, durations, metrics
 from job_server.models import JobStatus, JobPayload
-from job_server.queue import jobs_status
-from typing import List, Tuple
+from job_server.queue import is_cancelled, update_job_status
+from job_server.reports import file_output_dirs, file_summaries, load_report, match_file
+from job_server.runner import LOG_DIR, kill_job, run_job
+from job_server.warm_pool import WARM_RUNNERS, kill_warm_job, run_warm_job
+from typing import Dict, List, Set, Tuple
 
-NPX_PATH = r"C:\Program Files\nodejs\npx.cmd"
+NPX_PATH = os.environ.get("QGJOB_NPX_PATH", r"C:\Program Files\nodejs\npx.cmd")
+JOB_TIMEOUT = 600  # 10 minutes max per job
+
+# "per-job" starts one Playwright process per job; "group" hands every test path in
+# a group to a single Playwright process, paying Node/config/browser startup once
+GROUP_EXECUTION = os.environ.get("QGJOB_GROUP_EXECUTION", "per-job")
+# Playwright --workers for group execution
+PLAYWRIGHT_WORKERS = int(os.environ.get("QGJOB_PLAYWRIGHT_WORKERS", "1"))
+
+# Playwright runs in progress: run ID -> IDs of the jobs in it that haven't been cancelled
+_runs: Dict[str, Set[str]] = {}
+_runs_lock = threading.Lock()
+
+def run_playwright(run_id: str, job_ids: List[str], args: List[str], timeout: float, env=None) -> dict:
+    # Run `playwright <args>` for job_ids: on a pre-launched runner when the warm pool is
+    # enabled, otherwise as a fresh npx process
+    with _runs_lock:
+        _runs[run_id] = set(job_ids)
+    try:
+        if WARM_RUNNERS:
+            return run_warm_job(run_id, args, timeout, env)
+        return run_job(run_id, [NPX_PATH, "playwright", *args], timeout, env)
+    finally:
+        with _runs_lock:
+            del _runs[run_id]
+
+def cancel_run(job_id: str):
+    """Kill the Playwright run of a cancelled job once every job in that run has been cancelled."""
+    with _runs_lock:
+        run_id = next((run_id for run_id, job_ids in _runs.items() if job_id in job_ids), None)
+        if run_id is None:
+            return
+        _runs[run_id].discard(job_id)
+        if _runs[run_id]:
+            return
+    if WARM_RUNNERS:
+        kill_warm_job(run_id)
+    else:
+        kill_job(run_id)
+
+def shard_args(job: JobPayload) -> List[str]:
+    # A shard may get no tests of a small spec, which isn't a failure
+    if job.shard_index is None:
+        return []
+    return [f"--shard={job.shard_index}/{job.shards}", "--pass-with-no-tests"]
+
+def run_group(group_key, jobs: List[Tuple[str, JobPayload]], report=update_job_status, cancelled=is_cancelled):
+    # report(job_id, status, message=None, result=None) records a status transition:
+    # straight into the queue in-process, or back to the server from a standalone agent.
+    # cancelled(job_id) says whether the job was cancelled since the group was claimed.
+    if GROUP_EXECUTION == "group" and len(jobs) > 1:
+        # --grep applies to a whole Playwright run, so retries of failed tests run on their own
+        run_group_in_one_process(group_key, [(job_id, job) for job_id, job in jobs if job.grep is None], report, cancelled)
+        jobs = [(job_id, job) for job_id, job in jobs if job.grep is not None]
 
-def run_group(group_key, jobs: List[Tuple[str, JobPayload]]):
     # Run all jobs in a group using Playwright
     for job_id, job in jobs:
-        jobs_status[job_id].status = "running"
+        if cancelled(job_id):
+            continue
+        report(job_id, "running")
         test_path = job.test_path
-        command = [
-            NPX_PATH, "playwright", "test", test_path, "--headed"
-        ]
+        report_path = os.path.join(LOG_DIR, f"{job_id}.json")
+        # Each job gets its own output directory, collected into the artifact store afterwards
+        output_dir = artifacts.output_dir(job_id)
+        args = ["test", test_path, "--headed", "--reporter=list,json", f"--output={output_dir}", *shard_args(job)]
+        if job.grep is not None:
+            args.append(f"--grep={job.grep}")
         try:
-            result = subprocess.run(
-                command,
-                capture_output=True,
-                text=True,
-                timeout=600  # 10 minutes max per job
+            # Output streams to a per-job log file; the result only keeps its tail
+            started = time.perf_counter()
+            result = run_playwright(
+                job_id, [job_id], args, timeout=JOB_TIMEOUT, env={"PLAYWRIGHT_JSON_OUTPUT_NAME": report_path}
+            )
+            result["duration"] = time.perf_counter() - started
+            metrics.run_duration.observe(result["duration"])
+            durations.record(job, result["duration"])
+            result["artifacts"] = artifacts.collect(output_dir)
+            playwright_report = load_report(report_path)
+            summaries = file_summaries(playwright_report) if playwright_report else {}
+            name = match_file(test_path, summaries)
+            result["tests"] = summaries[name] if name else None
+            result["report_path"] = report_path
+            passed = result["exit_code"] == 0 and (name is None or summaries[name]["ok"])
+            report(
+                job_id,
+                "completed" if passed else "failed",
+                message=f"Job {job_id} finished with exit code {result['exit_code']}.",
+                result=result
             )
-            jobs_status[job_id].status = "completed" if result.returncode == 0 else "failed"
-            jobs_status[job_id].message = f"Job {job_id} finished with exit code {result.returncode}."
-            jobs_status[job_id].result = {
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "exit_code": result.returncode
-            }
         except Exception as e:
-            jobs_status[job_id].status = "failed"
-            jobs_status[job_id].message = f"Job {job_id} failed to run: {str(e)}"
-            jobs_status[job_id].result = {
-                "stdout": "",
-                "stderr": str(e),
-                "exit_code": -1
-            } 
\ No newline at end of file
+            report(
+                job_id,
+                "failed",
+                message=f"Job {job_id} failed to run: {str(e)}",
+                result={
+                    "stdout": "",
+                    "stderr": str(e),
+                    "exit_code": -1,
+                    "artifacts": artifacts.collect(output_dir)
+                }
+            )
+
+def run_group_in_one_process(group_key, jobs: List[Tuple[str, JobPayload]], report=update_job_status,
+                             cancelled=is_cancelled):
+    # Run every test path in the group with one Playwright invocation and map the
+    # JSON report back to the jobs (jobs sharing a test path share its outcome)
+    jobs = [(job_id, job) for job_id, job in jobs if not cancelled(job_id)]
+    if not jobs:
+        return
+    run_id = f"group-{jobs[0][0]}"
+    report_path = os.path.join(LOG_DIR, f"{run_id}.json")
+    output_dir = artifacts.output_dir(run_id)
+    test_paths = list(dict.fromkeys(job.test_path for _, job in jobs))
+    # Jobs in a group are all the same shard (or all unsharded), see queue.group_key_for
+    args = [
+        "test", *test_paths, "--headed", f"--workers={PLAYWRIGHT_WORKERS}", "--reporter=list,json",
+        f"--output={output_dir}", *shard_args(jobs[0][1])
+    ]
+    for job_id, _ in jobs:
+        report(job_id, "running")
+    try:
+        started = time.perf_counter()
+        result = run_playwright(
+            run_id, [job_id for job_id, _ in jobs], args, timeout=JOB_TIMEOUT * len(test_paths),
+            env={"PLAYWRIGHT_JSON_OUTPUT_NAME": report_path}
+        )
+        metrics.run_duration.observe(time.perf_counter() - started)
+    except Exception as e:
+        manifest = artifacts.collect(output_dir)
+        for job_id, _ in jobs:
+            report(
+                job_id,
+                "failed",
+                message=f"Job {job_id} failed to run: {str(e)}",
+                result={"stdout": "", "stderr": str(e), "exit_code": -1, "artifacts": manifest}
+            )
+        return
+
+    playwright_report = load_report(report_path)
+    summaries = file_summaries(playwright_report) if playwright_report else {}
+    # Artifacts go to the jobs whose tests attached them; files no test claims go to every job
+    manifest = artifacts.collect(output_dir)
+    output_dirs = file_output_dirs(playwright_report, output_dir) if playwright_report else {}
+    claimed = set().union(*output_dirs.values())
+    for job_id, job in jobs:
+        name = match_file(job.test_path, summaries)
+        job_dirs = output_dirs.get(name, set())
+        job_artifacts = {
+            path: entry for path, entry in manifest.items()
+            if path.split("/")[0] in job_dirs or path.split("/")[0] not in claimed
+        }
+        if name is None:
+            # No per-file result (no JSON report, a directory test path, a shard that got none of
+            # the file's tests): fall back to the process exit code, as a per-job run does
+            exit_code = result["exit_code"]
+            tests = None
+        else:
+            exit_code = 0 if summaries[name]["ok"] else 1
+            tests = summaries[name]
+            durations.record(job, tests["duration"])
+        report(
+            job_id,
+            "completed" if exit_code == 0 else "failed",
+            message=f"Job {job_id} finished with exit code {exit_code} (group run {run_id}).",
+            result={
+                **result, "exit_code": exit_code, "tests": tests, "report_path": report_path,
+                "duration": tests["duration"] if tests else None, "artifacts": job_artifacts
+            }
+        )
+
+class LeaseReporter:
+    """Reports job progress for a leased group to the server and keeps the lease alive."""
+
+    def __init__(self, session: requests.Session, server_url: str, agent_id: str, lease: dict):
+        self.session = session
+        self.server_url = server_url
+        self.url = f"{server_url}/agents/{agent_id}"
+        self.lease_id = lease["lease_id"]
+        self.interval = lease["lease_timeout"] / 3
+        self.lost = False
+        self._cancelled: Set[str] = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+
+    def __call__(self, job_id, status, message=None, result=None):
+        # Artifacts are stored on this host; the server needs its own copy to serve them
+        self.upload_artifacts(artifacts.manifest_for(result))
+        # Send every transition right away so clients see each job finish, not just the group
+        self.heartbeat([{"job_id": job_id, "status": status, "message": message, "result": result}])
+
+    def heartbeat(self, updates=()):
+        try:
+            response = self.session.post(f"{self.url}/heartbeat", json={"lease_id": self.lease_id, "updates": list(updates)}, timeout=10)
+            self.lost = self.lost or response.status_code == 409
+        except requests.RequestException as e:
+            print(f"Heartbeat for lease {self.lease_id} failed: {e}")
+            return
+        if response.ok:
+            # The server answers with the lease's jobs that have been cancelled
+            for job_id in set(response.json().get("cancelled", [])) - self._cancelled:
+                self._cancelled.add(job_id)
+                cancel_run(job_id)
+
+    def upload_artifacts(self, manifest: Dict[str, dict]):
+        for entry in manifest.values():
+            url = f"{self.server_url}/artifacts/{artifacts.object_name(entry)}"
+            try:
+                # Content-addressed: an object the server already has (from any job) isn't sent again
+                if self.session.head(url, timeout=10).status_code == 200:
+                    continue
+                with open(artifacts.object_path(entry), "rb") as f:
+                    self.session.put(url, data=f, timeout=300).raise_for_status()
+            except (OSError, requests.RequestException) as e:
+                print(f"Uploading artifact {entry['sha256']} failed: {e}")
+
+    def cancelled(self, job_id: str) -> bool:
+        return job_id in self._cancelled
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.interval):
+            self.heartbeat()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        if self.lost:
+            print(f"Lease {self.lease_id} expired; its jobs were handed to another agent")
+            return
+        try:
+            response = self.session.post(f"{self.url}/complete", json={"lease_id": self.lease_id}, timeout=30)
+        except requests.RequestException as e:
+            # Results already sent with heartbeats stand; the lease expires and the rest is queued again
+            print(f"Completing lease {self.lease_id} failed: {e}; it will expire")
+            return
+        if response.status_code == 409:
+            print(f"Lease {self.lease_id} expired before completion; results discarded")
+        elif not response.ok:
+            print(f"Completing lease {self.lease_id} failed with HTTP {response.status_code}; it will expire")
+
+def work(server_url: str, agent_id: str, wait: float = 30, targets=None):
+    """Lease groups from the server (for `targets`, or any target) and run them until interrupted."""
+    session = requests.Session()
+    print(f"Agent {agent_id} pulling work from {server_url}")
+    while True:
+        try:
+            response = session.post(f"{server_url}/agents/lease", json={"agent_id": agent_id, "wait": wait, "targets": targets}, timeout=wait + 10)
+            if response.status_code == 204:
+                continue
+            # e.g. 503 while the server's API workers elect a new primary
+            response.raise_for_status()
+            lease = response.json()
+        except requests.RequestException as e:
+            print(f"Lease request failed: {e}")
+            time.sleep(5)
+            continue
+        jobs = [(job["job_id"], JobPayload(**job["payload"])) for job in lease["jobs"]]
+        print(f"Running group {lease['group_key']} ({len(jobs)} jobs) under lease {lease['lease_id']}")
+        with LeaseReporter(session, server_url, agent_id, lease) as reporter:
+            run_group(tuple(lease["group_key"]), jobs, report=reporter, cancelled=reporter.cancelled)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Standalone agent that leases job groups from a qgjob server")
+    parser.add_argument("--server", default="http://localhost:8000", help="Job server URL")
+    parser.add_argument("--agent-id", default=f"{socket.gethostname()}-{os.getpid()}", help="Unique agent name")
+    parser.add_argument("--wait", type=float, default=30, help="Seconds to long-poll for work per lease request")
+    parser.add_argument("--target", dest="targets", action="append", help="Only lease groups for this target (repeatable)")
+    args = parser.parse_args()
+    work(args.server.rstrip("/"), args.agent_id, args.wait, args.targets)
@@ -0,0 +1,111 @@
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import zlib
+from typing import Dict, Iterator, Optional
+
+# Test artifacts (traces, screenshots, videos) are kept here, once per distinct content:
+# objects/<first two hex digits>/<sha256>[.gz]. Job results only list paths and hashes
+ARTIFACT_DIR = os.environ.get("QGJOB_ARTIFACT_DIR", "artifacts")
+# Formats that are compressed already are stored as they are, so they can be served
+# straight from disk with ranges; everything else (logs, JSON, HTML, ...) is gzipped
+STORED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webm", ".mp4", ".zip", ".gz"}
+CHUNK_BYTES = 1024 * 1024
+OBJECT_NAME = re.compile(r"^[0-9a-f]{64}(\.gz)?$")
+
+def output_dir(run_id: str) -> str:
+    """Directory a run should have Playwright write its output to (--output); collect() empties it."""
+    # Under ARTIFACT_DIR, so stored-as-is files can be moved into place rather than copied
+    return os.path.abspath(os.path.join(ARTIFACT_DIR, "incoming", run_id))
+
+def object_name(entry: dict) -> str:
+    return entry["sha256"] + (".gz" if entry["encoding"] == "gzip" else "")
+
+def object_path(entry: dict) -> str:
+    return os.path.join(ARTIFACT_DIR, "objects", entry["sha256"][:2], object_name(entry))
+
+def has_object(entry: dict) -> bool:
+    return os.path.exists(object_path(entry))
+
+def _sha256(path: str, decompress: bool = False) -> str:
+    digest = hashlib.sha256()
+    with (gzip.open(path, "rb") if decompress else open(path, "rb")) as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def store_file(path: str) -> dict:
+    """Add the file at path to the store (consuming it) and return its manifest entry."""
+    entry = {
+        "sha256": _sha256(path),
+        "size": os.path.getsize(path),
+        "encoding": None if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS else "gzip",
+    }
+    target = object_path(entry)
+    if os.path.exists(target):
+        os.remove(path)
+        return entry
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if entry["encoding"] is None:
+        os.replace(path, target)
+        return entry
+    # Written under a temporary name and renamed, so readers never see half an object
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target))
+    try:
+        with os.fdopen(fd, "wb") as out, open(path, "rb") as src:
+            with gzip.GzipFile(fileobj=out, mode="wb", mtime=0) as compressed:
+                shutil.copyfileobj(src, compressed, CHUNK_BYTES)
+        os.replace(tmp_path, target)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.remove(path)
+    return entry
+
+def collect(directory: str) -> Dict[str, dict]:
+    """Store every file under directory and remove it. Returns the manifest: relative path -> entry."""
+    manifest = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            manifest[os.path.relpath(path, directory).replace("\\", "/")] = store_file(path)
+    shutil.rmtree(directory, ignore_errors=True)
+    return manifest
+
+def add_object(name: str, path: str) -> bool:
+    """Move an uploaded object (named like object_name) into the store if its content matches its name."""
+    if not OBJECT_NAME.match(name):
+        os.remove(path)
+        return False
+    digest, _, extension = name.partition(".")
+    try:
+        valid = _sha256(path, decompress=extension == "gz") == digest
+    except (OSError, EOFError, zlib.error):
+        valid = False
+    if not valid:
+        os.remove(path)
+        return False
+    target = os.path.join(ARTIFACT_DIR, "objects", digest[:2], name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(path, target)
+    return True
+
+def upload_path() -> str:
+    """A fresh temporary file in the store for an upload to be written to before add_object."""
+    directory = os.path.join(ARTIFACT_DIR, "incoming")
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, suffix=".upload")
+    os.close(fd)
+    return path
+
+def read_decompressed(entry: dict) -> Iterator[bytes]:
+    """Chunks of an object's original content, for clients that don't accept gzip."""
+    with gzip.open(object_path(entry), "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b""):
+            yield chunk
+
+def manifest_for(result: Optional[dict]) -> Dict[str, dict]:
+    return (result or {}).get("artifacts") or {}
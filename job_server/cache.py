@@ -0,0 +1,94 @@
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from job_server.models import JobPayload
+
+# Cached results of successful runs, for jobs submitted with use_cache=True
+RESULT_CACHE_TTL = float(os.environ.get("QGJOB_RESULT_CACHE_TTL", "3600"))
+RESULT_CACHE_SIZE = int(os.environ.get("QGJOB_RESULT_CACHE_SIZE", "1024"))
+# Files whose content is part of every cache key, since they change how a spec runs
+PLAYWRIGHT_CONFIG_FILES = os.environ.get(
+    "QGJOB_PLAYWRIGHT_CONFIG_FILES", "playwright.config.ts,playwright.config.js,appwright.config.ts"
+).split(",")
+
+CacheKey = Tuple[str, str, str]
+
+# path -> (mtime_ns, size, sha256) so unchanged files aren't re-read on every submit
+_digests: Dict[str, Tuple[int, int, str]] = {}
+
+def _file_digest(path: str) -> Optional[str]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    cached = _digests.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    try:
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+    _digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+def _test_path_digest(path: str) -> Optional[str]:
+    # Playwright also takes a directory of specs: hash every file in it, with its relative path
+    if not os.path.isdir(path):
+        return _file_digest(path)
+    content = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            file_digest = _file_digest(file_path)
+            if file_digest is None:
+                return None
+            content.update(f"{os.path.relpath(file_path, path)}:{file_digest}".encode())
+    return content.hexdigest()
+
+def cache_key(job: JobPayload) -> Optional[CacheKey]:
+    """(app_version_id, target, hash of the test file or directory and Playwright config), or None if the tests can't be read."""
+    test_digest = _test_path_digest(job.test_path)
+    if test_digest is None:
+        return None
+    content = hashlib.sha256(test_digest.encode())
+    for path in PLAYWRIGHT_CONFIG_FILES:
+        content.update(f"{path}:{_file_digest(path)}".encode())
+    if job.grep is not None:
+        content.update(f"grep:{job.grep}".encode())
+    return (job.app_version_id, job.target, content.hexdigest())
+
+class ResultCache:
+    """LRU cache of job results with a TTL. Not thread-safe; the queue guards it with its lock."""
+
+    def __init__(self, ttl: float = RESULT_CACHE_TTL, max_entries: int = RESULT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[CacheKey, Tuple[float, str, dict]]" = OrderedDict()
+
+    def get(self, key: CacheKey) -> Optional[Tuple[str, dict]]:
+        """Return (job_id that produced it, result) for a live entry."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, job_id, result = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return job_id, result
+
+    def put(self, key: CacheKey, job_id: str, result: dict):
+        self._entries[key] = (time.monotonic() + self.ttl, job_id, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
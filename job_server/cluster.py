@@ -0,0 +1,206 @@
+import os
+import socket
+import threading
+import time
+from functools import partial
+from typing import Callable, Optional
+from urllib.parse import parse_qs
+import anyio
+import requests
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from job_server.store import DB_PATH
+
+# Running the API with several worker processes (job_server.serve --workers N, which sets
+# API_WORKERS) over the SQLite store: the worker holding LOCK_PATH is the primary. It keeps the queue in memory, runs the
+# scheduler, and also listens on 127.0.0.1:PRIMARY_PORT. The other workers serve status
+# reads from the shared database (asking the primary about jobs not committed there yet)
+# and forward everything else there. When the primary exits, the OS drops its lock and
+# another worker takes over within ELECTION_INTERVAL.
+# A single worker (the default, e.g. plain `uvicorn job_server.main:app`) does none of this
+API_WORKERS = int(os.environ.get("QGJOB_API_WORKERS", "1"))
+LOCK_PATH = os.environ.get("QGJOB_PRIMARY_LOCK", DB_PATH + ".primary")
+PRIMARY_PORT = int(os.environ.get("QGJOB_PRIMARY_PORT", "8001"))
+ELECTION_INTERVAL = float(os.environ.get("QGJOB_ELECTION_INTERVAL", "1"))
+FORWARD_CHUNK_BYTES = 64 * 1024
+# Forwarded requests may be long-polls and event streams that wait for minutes, so they get
+# threads of their own rather than the ones requests are served with
+FORWARD_THREADS = int(os.environ.get("QGJOB_FORWARD_THREADS", "1000"))
+# Not passed through when forwarding; they describe one connection, not the message
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "host", "content-length"}
+
+# enabled: start() was called, i.e. the store is shared and there may be other workers
+enabled = False
+is_primary = False
+_lock_file = None
+_session = requests.Session()
+_forward_limiter: Optional[anyio.CapacityLimiter] = None
+
+if os.name == "nt":
+    import msvcrt
+
+    def _try_lock(f) -> bool:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+else:
+    import fcntl
+
+    def _try_lock(f) -> bool:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+def _try_become_primary() -> bool:
+    global _lock_file, is_primary
+    f = open(LOCK_PATH, "a+")
+    if not _try_lock(f):
+        f.close()
+        return False
+    # Held for the life of the process. Emptied until _publish says where to forward to, so
+    # other workers answer 503 rather than forwarding to the previous primary
+    _lock_file = f
+    f.seek(0)
+    f.truncate()
+    f.flush()
+    is_primary = True
+    return True
+
+def _publish(url: str):
+    _lock_file.seek(0)
+    _lock_file.truncate()
+    _lock_file.write(url)
+    _lock_file.flush()
+
+def _serve_internal(app) -> str:
+    # Bound here, before the URL is published, so a taken port can't go unnoticed
+    import uvicorn
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    try:
+        sock.bind(("127.0.0.1", PRIMARY_PORT))
+    except OSError as e:
+        print(f"Can't listen on 127.0.0.1:{PRIMARY_PORT} for forwarded requests ({e}); using a free port instead")
+        sock.bind(("127.0.0.1", 0))
+    # The app is already started in this process, so no second lifespan. log_config=None
+    # leaves the logging of the server this worker was started with alone, and the
+    # forwarding worker has logged the request already
+    config = uvicorn.Config(app, lifespan="off", log_config=None, access_log=False)
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, name="primary-server", daemon=True).start()
+    return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+def start(app, on_elected: Callable[[], None]):
+    """Become the primary now if no other worker is, else keep trying in the background.
+    on_elected starts what only the primary runs (recovery, scheduler, ...)."""
+    global enabled
+    enabled = True
+
+    def become_primary():
+        on_elected()
+        if PRIMARY_PORT:
+            _publish(_serve_internal(app))
+
+    if _try_become_primary():
+        become_primary()
+        return
+
+    def election_loop():
+        while not _try_become_primary():
+            time.sleep(ELECTION_INTERVAL)
+        become_primary()
+
+    threading.Thread(target=election_loop, name="primary-election", daemon=True).start()
+
+def primary_url() -> Optional[str]:
+    try:
+        with open(LOCK_PATH) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def served_by_any_worker(method: str, path: str, query: str) -> bool:
+    """Requests that only read the shared store (or the artifact directory), so need no queue."""
+    if path.startswith("/artifacts/"):
+        return True
+    if method not in ("GET", "HEAD"):
+        return False
+    if path == "/jobs" or (path.startswith("/jobs/") and "/artifacts" in path):
+        return True
+    # A status read, unless it long-polls for a change, which only the primary sees
+    return path.startswith("/jobs/") and path.count("/") == 2 and parse_qs(query).get("wait", ["0"])[-1] in ("", "0")
+
+class RouteToPrimary:
+    """ASGI middleware: on workers other than the primary, forwards requests that need the queue."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not enabled or is_primary:
+            await self.app(scope, receive, send)
+            return
+        if served_by_any_worker(scope["method"], scope["path"], scope["query_string"].decode("latin-1")):
+            if not scope["path"].startswith("/jobs/"):
+                await self.app(scope, receive, send)
+                return
+            # A job submitted moments ago may not be committed yet, so a 404 is asked of the primary
+            missing = False
+
+            async def send_unless_missing(message):
+                nonlocal missing
+                if message["type"] == "http.response.start" and message["status"] == 404:
+                    missing = True
+                if not missing:
+                    await send(message)
+
+            await self.app(scope, receive, send_unless_missing)
+            if not missing:
+                return
+        response = await forward(Request(scope, receive))
+        await response(scope, receive, send)
+
+async def _in_forward_thread(func, *args, **kwargs):
+    global _forward_limiter
+    if _forward_limiter is None:
+        # Needs the event loop, so made on first use
+        _forward_limiter = anyio.CapacityLimiter(FORWARD_THREADS)
+    return await anyio.to_thread.run_sync(partial(func, *args, **kwargs), limiter=_forward_limiter)
+
+async def forward(request: Request) -> Response:
+    """Send a request on to the primary and stream its response back."""
+    url = primary_url()
+    if url is None:
+        return JSONResponse({"detail": "No primary worker yet"}, status_code=503, headers={"Retry-After": "1"})
+    if request.url.query:
+        target = f"{url}{request.url.path}?{request.url.query}"
+    else:
+        target = f"{url}{request.url.path}"
+    headers = {key: value for key, value in request.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+    body = await request.body()
+    try:
+        # No read timeout: long-polls and event streams stay open as long as the client wants
+        upstream = await _in_forward_thread(
+            _session.request, request.method, target, data=body, headers=headers, stream=True, timeout=(5, None)
+        )
+    except requests.RequestException:
+        return JSONResponse({"detail": "Primary worker unavailable"}, status_code=503, headers={"Retry-After": "1"})
+
+    async def relay():
+        chunks = upstream.raw.stream(FORWARD_CHUNK_BYTES, decode_content=False)
+        try:
+            while True:
+                chunk = await _in_forward_thread(next, chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            upstream.close()
+
+    response_headers = {key: value for key, value in upstream.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+    if "content-length" in upstream.headers:
+        response_headers["content-length"] = upstream.headers["content-length"]
+    return StreamingResponse(relay(), status_code=upstream.status_code, headers=response_headers)
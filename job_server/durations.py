@@ -0,0 +1,52 @@
+import os
+from typing import Dict, List, Optional, Tuple
+from job_server.models import JobPayload
+
+# Run time history per (test_path, target): an exponentially weighted moving average, so
+# recent runs count most and each key costs two numbers however often it runs
+DURATION_ALPHA = float(os.environ.get("QGJOB_DURATION_ALPHA", "0.3"))
+# Expected seconds for a test that hasn't run yet on a target nothing has run on either
+DEFAULT_EXPECTED_SECONDS = float(os.environ.get("QGJOB_DEFAULT_EXPECTED_SECONDS", "60"))
+
+# (test_path, target) -> [average seconds, runs]. Updated without a lock: a racing update
+# can lose one sample, which an estimate can afford
+_history: Dict[Tuple[str, str], List[float]] = {}
+# target -> moving average over all its runs; the guess for a test with no history of its own
+_target_average: Dict[str, float] = {}
+
+def record(job: JobPayload, seconds: float):
+    """Add one run of job to its history. A shard's run is counted as a full run's share; a run of
+    only some of the file's tests (--grep) isn't counted."""
+    if job.grep is not None:
+        return
+    if job.shard_index is not None:
+        seconds *= job.shards
+    stats = _history.get((job.test_path, job.target))
+    if stats is None:
+        _history[(job.test_path, job.target)] = [seconds, 1]
+    else:
+        stats[0] += DURATION_ALPHA * (seconds - stats[0])
+        stats[1] += 1
+    average = _target_average.get(job.target, seconds)
+    _target_average[job.target] = average + DURATION_ALPHA * (seconds - average)
+
+def record_result(job: JobPayload, result: Optional[dict]):
+    """Record the run time reported in a job result ("duration", in seconds), if it has one."""
+    if result and isinstance(result.get("duration"), (int, float)):
+        record(job, result["duration"])
+
+def expected(job: JobPayload) -> float:
+    """Expected run time of job in seconds."""
+    stats = _history.get((job.test_path, job.target))
+    if stats is None:
+        seconds = _target_average.get(job.target, DEFAULT_EXPECTED_SECONDS)
+    else:
+        seconds = stats[0]
+    return seconds / job.shards if job.shard_index is not None else seconds
+
+def history() -> Dict[Tuple[str, str], Tuple[float, int]]:
+    return {key: (stats[0], int(stats[1])) for key, stats in list(_history.items())}
+
+def reset():
+    _history.clear()
+    _target_average.clear()
@@ -0,0 +1,50 @@
+import asyncio
+import threading
+from typing import Dict, Iterable, Mapping, Set, Tuple
+
+# Per-job change counters. Every status transition bumps the job's version and wakes
+# any asyncio waiters registered for it, whichever thread recorded the change.
+_versions: Dict[str, int] = {}
+_waiters: Dict[str, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]]] = {}
+_lock = threading.Lock()
+
+def version(job_id: str) -> int:
+    return _versions.get(job_id, 0)
+
+def notify(job_id: str):
+    """Record a status change for job_id and wake everyone waiting on it."""
+    with _lock:
+        _versions[job_id] = _versions.get(job_id, 0) + 1
+        waiters = list(_waiters.get(job_id, ()))
+    for loop, event in waiters:
+        loop.call_soon_threadsafe(event.set)
+
+def forget(job_ids: Iterable[str]):
+    """Drop the version counters of jobs that are no longer tracked."""
+    with _lock:
+        for job_id in job_ids:
+            _versions.pop(job_id, None)
+
+async def wait_for_change(seen: Mapping[str, int], timeout: float) -> bool:
+    """Wait until any job in seen moves past the version recorded for it. Returns False on timeout."""
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+    waiter = (loop, event)
+    with _lock:
+        if any(_versions.get(job_id, 0) != v for job_id, v in seen.items()):
+            return True
+        for job_id in seen:
+            _waiters.setdefault(job_id, set()).add(waiter)
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        with _lock:
+            for job_id in seen:
+                waiters = _waiters.get(job_id)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del _waiters[job_id]
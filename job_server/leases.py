@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+from job_server import durations
+from job_server.models import JobPayload, JobUpdate
+from job_server.queue import GroupKey, get_next_group, is_cancelled, requeue_group, update_job_status
+
+# An agent must heartbeat within this many seconds or its group is queued again
+LEASE_TIMEOUT = float(os.environ.get("QGJOB_LEASE_TIMEOUT", "60"))
+
+class LeaseError(Exception):
+    """The lease doesn't exist (anymore) or belongs to another agent."""
+
+class Lease:
+    __slots__ = ("lease_id", "agent_id", "group_key", "jobs", "expires_at")
+
+    def __init__(self, agent_id: str, group_key: GroupKey, jobs: List[Tuple[str, JobPayload]]):
+        self.lease_id = str(uuid.uuid4())
+        self.agent_id = agent_id
+        self.group_key = group_key
+        self.jobs = list(jobs)
+        self.expires_at = time.monotonic() + LEASE_TIMEOUT
+
+leases: Dict[str, Lease] = {}
+_lock = threading.Lock()
+
+def acquire(agent_id: str, wait: float = 0, targets: Optional[List[str]] = None) -> Optional[Lease]:
+    """Claim the next group for an agent (on one of `targets`, if given), waiting up to `wait` seconds for one."""
+    expire_leases()
+    group = get_next_group(block=wait > 0, timeout=wait, targets=targets, slot=agent_id)
+    if group is None:
+        return None
+    lease = Lease(agent_id, *group)
+    with _lock:
+        leases[lease.lease_id] = lease
+    return lease
+
+def _owned(agent_id: str, lease_id: str) -> Lease:
+    # Caller must hold _lock
+    lease = leases.get(lease_id)
+    if lease is None or lease.agent_id != agent_id:
+        raise LeaseError(f"Lease {lease_id} is not held by agent {agent_id}")
+    return lease
+
+def _apply_updates(lease: Lease, updates: List[JobUpdate]):
+    jobs = dict(lease.jobs)
+    for update in updates:
+        if update.job_id in jobs:
+            update_job_status(update.job_id, update.status, update.message, update.result)
+            # The agent's run times feed this server's dispatch policy
+            durations.record_result(jobs[update.job_id], update.result)
+
+def heartbeat(agent_id: str, lease_id: str, updates: List[JobUpdate]) -> Tuple[float, List[str]]:
+    """Extend a lease and record job progress. Returns seconds until the lease expires and the
+    IDs of the lease's jobs that have been cancelled, which the agent should stop or skip."""
+    with _lock:
+        lease = _owned(agent_id, lease_id)
+        lease.expires_at = time.monotonic() + LEASE_TIMEOUT
+    _apply_updates(lease, updates)
+    return LEASE_TIMEOUT, [job_id for job_id, _ in lease.jobs if is_cancelled(job_id)]
+
+def complete(agent_id: str, lease_id: str, results: List[JobUpdate]):
+    """Record final job results and release the lease. Jobs without a final result are queued again."""
+    with _lock:
+        lease = leases.pop(_owned(agent_id, lease_id).lease_id)
+    _apply_updates(lease, results)
+    # Drops the finished jobs; anything still unfinished goes back to the queue
+    requeue_group(lease.group_key, lease.jobs, f"Re-queued: not finished under the lease of agent {agent_id}")
+
+def expire_leases() -> int:
+    """Queue the groups of agents that stopped heartbeating again. Returns how many leases expired."""
+    now = time.monotonic()
+    with _lock:
+        expired = [lease for lease in leases.values() if lease.expires_at < now]
+        for lease in expired:
+            del leases[lease.lease_id]
+    for lease in expired:
+        requeue_group(lease.group_key, lease.jobs, f"Re-queued: lease of agent {lease.agent_id} expired")
+    return len(expired)
+
+def start_lease_reaper():
+    def reaper_loop():
+        while True:
+            time.sleep(LEASE_TIMEOUT / 4)
+            expire_leases()
+    threading.Thread(target=reaper_loop, name="lease-reaper", daemon=True).start()
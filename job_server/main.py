@@ -1,30 +1,306 @@
-from fastapi import FastAPI, HTTPException
-from job_server.models import JobPayload, JobStatus
-from job_server.queue import enqueue_job, get_job_status, job_groups
+import mimetypes
+import os
+import time
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+from typing import List, Optional
+from job_server.models import JobPayload, JobStatus, LeaseCompletion, LeaseHeartbeat, LeaseRequest
+from job_server import artifacts, cluster, durations, events, leases, metrics, queue
+from job_server.queue import (
+    TERMINAL_STATUSES, cancel_job, enqueue_job, enqueue_jobs, get_job_status, job_groups, init_store, recover_jobs,
+    start_deadline_checks, start_eviction
+)
 from job_server.scheduler import start_scheduler
 
+MAX_WAIT_SECONDS = 60
+MAX_LIST_LIMIT = 1000
+SSE_KEEPALIVE_SECONDS = 15
+# JobPayload fields only the server sets: on the shards of a sharded job and on retries
+SERVER_SET_FIELDS = ("shard_index", "retry_of")
+
 app = FastAPI()
+app.add_middleware(cluster.RouteToPrimary)
+
+def _queue_depths():
+    # Queued (not yet claimed) jobs per group
+    for group_key, jobs in list(job_groups.items()):
+        if jobs:
+            yield {"group": str(group_key), "target": group_key[1], "org_id": group_key[2]}, len(jobs)
+
+def _jobs_by_status():
+    counts = {}
+    for record in list(queue.jobs_status.values()):
+        counts[record.status] = counts.get(record.status, 0) + 1
+    for status, count in counts.items():
+        yield {"status": status}, count
+
+def _busy_slots():
+    for target, busy in list(queue.busy_slots.items()):
+        yield {"target": target}, busy
+
+metrics.Gauge("qgjob_queue_depth", "Queued jobs per group", _queue_depths)
+metrics.Gauge("qgjob_jobs", "Jobs held in memory, by status", _jobs_by_status)
+metrics.Gauge("qgjob_busy_slots", "Target slots held by running groups", _busy_slots)
+
+def start_primary():
+    # Everything that works on the in-memory queue
+    recover_jobs()
+    start_eviction()
+    start_deadline_checks()
+    leases.start_lease_reaper()
+    start_scheduler()
 
 @app.on_event("startup")
 def on_startup():
-    start_scheduler()
+    init_store()
+    if queue.store.keeps_results and cluster.API_WORKERS > 1:
+        # Workers share the SQLite store; one of them owns the queue (see cluster.py)
+        cluster.start(app, start_primary)
+    else:
+        start_primary()
+
+@app.on_event("shutdown")
+def on_shutdown():
+    queue.store.close()
+
+def _reject_server_set_fields(jobs: List[JobPayload]):
+    for job in jobs:
+        for field in SERVER_SET_FIELDS:
+            if getattr(job, field) is not None:
+                raise HTTPException(status_code=422, detail=f"{field} is set by the server and can't be submitted")
 
 @app.post("/jobs", response_model=dict)
 def submit_job(job: JobPayload):
+    _reject_server_set_fields([job])
     job_id = enqueue_job(job)
     return {"job_id": job_id}
 
+@app.post("/jobs:batch", response_model=dict)
+def submit_jobs(jobs: List[JobPayload]):
+    _reject_server_set_fields(jobs)
+    job_ids = enqueue_jobs(jobs)
+    return {"job_ids": job_ids}
+
+@app.get("/jobs", response_model=dict)
+def list_jobs(
+    org_id: Optional[str] = None,
+    status: Optional[str] = None,
+    app_version_id: Optional[str] = None,
+    target: Optional[str] = None,
+    cursor: Optional[int] = Query(None, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_LIST_LIMIT),
+):
+    # Newest first; pass next_cursor back as cursor for the next page
+    filters = {"org_id": org_id, "status": status, "app_version_id": app_version_id, "target": target}
+    statuses, next_cursor = queue.list_jobs({k: v for k, v in filters.items() if v is not None}, cursor, limit)
+    return {
+        "jobs": [{"job_id": job.job_id, "status": job.status, "message": job.message} for job in statuses],
+        "next_cursor": next_cursor,
+    }
+
 @app.get("/jobs/{job_id}", response_model=JobStatus)
-def job_status(job_id: str):
+async def job_status(
+    job_id: str,
+    response: Response,
+    wait: float = Query(0, ge=0, le=MAX_WAIT_SECONDS),
+    if_none_match: Optional[str] = Header(None),
+):
+    # Long-poll: when If-None-Match still matches the current ETag, hold the request
+    # for up to `wait` seconds until the status changes, then 304 if it never did
+    deadline = time.monotonic() + wait
+    while True:
+        version = events.version(job_id)
+        status = await run_in_threadpool(get_job_status, job_id)
+        if status.status == "not_found":
+            raise HTTPException(status_code=404, detail="Job not found")
+        etag = f'"{version}-{status.status}"'
+        if etag != if_none_match:
+            response.headers["ETag"] = etag
+            return status
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not await events.wait_for_change({job_id: version}, remaining):
+            return Response(status_code=304, headers={"ETag": etag})
+
+@app.delete("/jobs/{job_id}", response_model=JobStatus)
+def delete_job(job_id: str):
+    # Cancels the job; a job that already finished is left as it is (409)
+    if not cancel_job(job_id):
+        status = get_job_status(job_id)
+        if status.status == "not_found":
+            raise HTTPException(status_code=404, detail="Job not found")
+        raise HTTPException(status_code=409, detail=f"Job already {status.status}")
+    return get_job_status(job_id)
+
+def _artifact_manifest(job_id: str) -> dict:
+    status = get_job_status(job_id)
+    if status.status == "not_found":
+        raise HTTPException(status_code=404, detail="Job not found")
+    return artifacts.manifest_for(status.result)
+
+@app.get("/jobs/{job_id}/artifacts")
+def list_artifacts(job_id: str):
+    manifest = _artifact_manifest(job_id)
+    return {
+        "job_id": job_id,
+        "artifacts": [
+            {"path": path, "size": entry["size"], "sha256": entry["sha256"]} for path, entry in sorted(manifest.items())
+        ]
+    }
+
+@app.get("/jobs/{job_id}/artifacts/{path:path}")
+def download_artifact(job_id: str, path: str, accept_encoding: Optional[str] = Header(None)):
+    # Served from disk in chunks (sendfile where the server supports it), with Range support
+    entry = _artifact_manifest(job_id).get(path)
+    if entry is None or not artifacts.has_object(entry):
+        raise HTTPException(status_code=404, detail="Artifact not found")
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = {"Cache-Control": "private, max-age=31536000, immutable", "ETag": f'"{artifacts.object_name(entry)}"'}
+    if entry["encoding"] is None:
+        return FileResponse(
+            artifacts.object_path(entry), media_type=media_type, headers=headers,
+            filename=os.path.basename(path), content_disposition_type="inline"
+        )
+    headers["Vary"] = "Accept-Encoding"
+    if "gzip" in (accept_encoding or ""):
+        return FileResponse(artifacts.object_path(entry), media_type=media_type, headers={**headers, "Content-Encoding": "gzip"})
+    return StreamingResponse(artifacts.read_decompressed(entry), media_type=media_type, headers=headers)
+
+@app.head("/artifacts/{name}")
+def artifact_exists(name: str):
+    # Lets agents skip uploading objects the store already has
+    exists = artifacts.OBJECT_NAME.match(name) and os.path.exists(
+        os.path.join(artifacts.ARTIFACT_DIR, "objects", name[:2], name)
+    )
+    return Response(status_code=200 if exists else 404)
+
+@app.put("/artifacts/{name}", status_code=204)
+async def upload_artifact(name: str, request: Request):
+    # An object from a remote agent's store, streamed to disk and checked against its hash
+    upload_path = await run_in_threadpool(artifacts.upload_path)
+    with open(upload_path, "wb") as f:
+        async for chunk in request.stream():
+            await run_in_threadpool(f.write, chunk)
+    if not await run_in_threadpool(artifacts.add_object, name, upload_path):
+        raise HTTPException(status_code=400, detail="Content doesn't match the object name")
+    return Response(status_code=204)
+
+@app.post("/jobs/{job_id}/retry", response_model=dict)
+def retry_job(job_id: str):
+    # Reruns only the failed tests of a finished job, as a new job
     status = get_job_status(job_id)
     if status.status == "not_found":
         raise HTTPException(status_code=404, detail="Job not found")
-    return status
+    if status.status not in TERMINAL_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Job is still {status.status}")
+    retry_id = queue.retry_failed_tests(job_id)
+    if retry_id is None:
+        raise HTTPException(status_code=409, detail="Job has no failed tests to retry")
+    return {"job_id": retry_id, "retry_of": job_id}
+
+@app.get("/jobs:events")
+async def job_events(job_id: List[str] = Query(...)):
+    """Server-sent events: the current status of each job, then every change until all have finished."""
+    async def stream():
+        seen = {id_: -1 for id_ in job_id}
+        while seen:
+            for id_, last in list(seen.items()):
+                version = events.version(id_)
+                if version == last:
+                    continue
+                status = await run_in_threadpool(get_job_status, id_)
+                yield f"event: status\ndata: {status.model_dump_json()}\n\n"
+                if status.status in TERMINAL_STATUSES or status.status == "not_found":
+                    del seen[id_]
+                else:
+                    seen[id_] = version
+            if seen and not await events.wait_for_change(seen, SSE_KEEPALIVE_SECONDS):
+                yield ": keepalive\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/agents/lease")
+async def lease_group(request: LeaseRequest):
+    # Long-polls up to request.wait seconds; 204 when there is nothing to run. Waits on the
+    # event loop rather than in a thread, so idle agents don't use up the request threads
+    deadline = time.monotonic() + min(request.wait, MAX_WAIT_SECONDS)
+    while True:
+        version = events.version(queue.GROUPS_CHANGED)
+        lease = await run_in_threadpool(leases.acquire, request.agent_id, 0, request.targets)
+        if lease is not None:
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not await events.wait_for_change({queue.GROUPS_CHANGED: version}, remaining):
+            return Response(status_code=204)
+    return {
+        "lease_id": lease.lease_id,
+        "group_key": list(lease.group_key),
+        "jobs": [{"job_id": job_id, "payload": job.model_dump()} for job_id, job in lease.jobs],
+        "lease_timeout": leases.LEASE_TIMEOUT,
+    }
+
+@app.post("/agents/{agent_id}/heartbeat")
+def lease_heartbeat(agent_id: str, heartbeat: LeaseHeartbeat):
+    try:
+        expires_in, cancelled = leases.heartbeat(agent_id, heartbeat.lease_id, heartbeat.updates)
+    except leases.LeaseError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"expires_in": expires_in, "cancelled": cancelled}
+
+@app.post("/agents/{agent_id}/complete")
+def lease_complete(agent_id: str, completion: LeaseCompletion):
+    try:
+        leases.complete(agent_id, completion.lease_id, completion.results)
+    except leases.LeaseError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"status": "ok"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/debug/groups")
 def debug_groups():
-    # Return a dict of group_key to list of job_ids
+    # Running and queued job_ids per group_key, and queued jobs and share weight per org
+    queued = list(job_groups.items())
+    groups = {str(group_key): [job_id for job_id, _ in jobs] for group_key, jobs in list(queue.active_groups.items())}
+    orgs = {}
+    for group_key, jobs in queued:
+        org_id = group_key[2]
+        org = orgs.setdefault(org_id, {"queued_jobs": 0, "weight": queue.org_weight(org_id)})
+        org["queued_jobs"] += len(jobs)
+        if jobs:
+            groups.setdefault(str(group_key), []).extend(job_id for job_id, _ in jobs)
+    return {"groups": groups, "orgs": orgs}
+
+@app.get("/debug/durations")
+def debug_durations():
+    # Average run time and run count per test path and target, as used by the dispatch policy
+    return {
+        "policy": queue.DISPATCH_POLICY,
+        "tests": [
+            {"test_path": test_path, "target": target, "average_seconds": round(average, 3), "runs": runs}
+            for (test_path, target), (average, runs) in durations.history().items()
+        ]
+    }
+
+@app.get("/debug/slots")
+def debug_slots():
+    # Capacity and busy slots per target
+    targets = set(queue.TARGET_SLOTS) | set(queue.busy_slots)
+    return {
+        target: {
+            "slots": queue.TARGET_SLOTS.get(target, queue.DEFAULT_TARGET_SLOTS),
+            "busy": queue.busy_slots.get(target, 0)
+        }
+        for target in sorted(targets)
+    }
+
+@app.get("/debug/warm")
+def debug_warm():
+    # App build each slot (scheduler worker or agent) has warm, as used for app affinity
+    now = time.monotonic()
     return {
-        str(group_key): [job_id for job_id, _ in jobs]
-        for group_key, jobs in job_groups.items() if jobs
-    } 
\ No newline at end of file
+        slot: {"app_version_id": app_version_id, "target": target, "idle_seconds": round(now - last_used, 1), "reuses": reuses}
+        for slot, (app_version_id, target, last_used, reuses) in list(queue.warm_slots.items())
+    }
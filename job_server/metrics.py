@@ -0,0 +1,110 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Prometheus-style metrics, cheap enough to leave on. Counters and histogram buckets are
+# plain preallocated ints bumped without locks: under the GIL a racing increment can
+# very rarely be lost, which is an acceptable trade for never blocking a hot path.
+# Gauges are computed from live state only when /metrics is scraped.
+
+_registry: List["Metric"] = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+class Metric(ABC):
+    __slots__ = ("name", "help")
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        _registry.append(self)
+
+    @abstractmethod
+    def samples(self) -> Iterable[str]:
+        ...
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self.samples()
+
+class Counter(Metric):
+    __slots__ = ("value",)
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield f"{self.name} {self.value}"
+
+class Histogram(Metric):
+    __slots__ = ("bounds", "counts", "sum")
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, bounds: Tuple[float, ...]):
+        super().__init__(name, help)
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last bucket is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound}"}} {cumulative}'
+        cumulative += self.counts[-1]
+        yield f'{self.name}_bucket{{le="+Inf"}} {cumulative}'
+        yield f"{self.name}_sum {self.sum}"
+        yield f"{self.name}_count {cumulative}"
+
+class Gauge(Metric):
+    """Sampled at scrape time: collect() returns (labels, value) pairs."""
+    __slots__ = ("collect",)
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, collect: Callable[[], Iterable[Tuple[Dict[str, str], float]]]):
+        super().__init__(name, help)
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in self.collect():
+            yield f"{self.name}{_labels(labels)} {value}"
+
+def render() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+jobs_submitted = Counter("qgjob_jobs_submitted_total", "Jobs accepted by the API")
+queue_wait = Histogram(
+    "qgjob_queue_wait_seconds", "Time from submission until a job starts running",
+    (0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600),
+)
+spawn_time = Histogram(
+    "qgjob_spawn_seconds", "Time to start a test subprocess",
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+run_duration = Histogram(
+    "qgjob_run_duration_seconds", "Wall time of a test run in agent.run_group",
+    (1, 5, 10, 30, 60, 120, 300, 600, 1200),
+)
+scheduler_iterations = Counter("qgjob_scheduler_iterations_total", "Scheduler worker loop iterations")
+scheduler_idle = Counter("qgjob_scheduler_idle_seconds_total", "Time scheduler workers spent waiting for work")
+warm_reuses = Counter("qgjob_warm_reuses_total", "Groups dispatched to a slot that already had their app build installed")
+setup_seconds_saved = Counter(
+    "qgjob_setup_seconds_saved_total", "Estimated app install and device boot seconds saved by warm reuse (QGJOB_SETUP_SECONDS)"
+)
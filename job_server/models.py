@@ -1,5 +1,9 @@
-from pydantic import BaseModel
-from typing import Optional
+import os
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+# Upper bound on JobPayload.shards. Each shard is its own group, queued under one lock hold
+MAX_SHARDS = int(os.environ.get("QGJOB_MAX_SHARDS", "100"))
 
 class JobPayload(BaseModel):
     org_id: str
@@ -7,9 +11,62 @@ class JobPayload(BaseModel):
     test_path: str
     priority: int = 1
     target: str
+    # Reuse the result of an identical earlier run, and share one run between identical queued jobs
+    use_cache: bool = False
+    # Split the run into this many Playwright --shard runs that can use separate slots in parallel
+    shards: int = Field(1, ge=1, le=MAX_SHARDS)
+    # Set by the server on the sub-jobs of a sharded job: which shard (1-based) this one runs.
+    # Submissions that set it (or retry_of) are rejected, see main.SERVER_SET_FIELDS
+    shard_index: Optional[int] = Field(None, ge=1)
+    # Cancel the job if it hasn't finished this many seconds after submission
+    deadline: Optional[float] = Field(None, gt=0)
+    # Branch the app build was made from. With supersede, this job cancels the queued jobs
+    # of the org's other builds of the branch, which it makes obsolete
+    branch: Optional[str] = None
+    supersede: bool = False
+    # Only run the tests whose titles match this regular expression (Playwright --grep). Set
+    # by the server on a retry of a job's failed tests, along with the job it retries
+    grep: Optional[str] = None
+    retry_of: Optional[str] = None
 
 class JobStatus(BaseModel):
     job_id: str
     status: str
     message: Optional[str] = None
-    result: Optional[dict] = None 
\ No newline at end of file
+    result: Optional[dict] = None
+
+class JobUpdate(BaseModel):
+    job_id: str
+    status: str
+    message: Optional[str] = None
+    result: Optional[dict] = None
+
+class LeaseRequest(BaseModel):
+    agent_id: str
+    # Targets this agent can run; None means any
+    targets: Optional[List[str]] = None
+    # Seconds to wait for a group to become available before answering 204
+    wait: float = 0
+
+class LeaseHeartbeat(BaseModel):
+    lease_id: str
+    # Status transitions since the last heartbeat (e.g. a job starting)
+    updates: List[JobUpdate] = []
+
+class LeaseCompletion(BaseModel):
+    lease_id: str
+    # Final status of each job in the group; jobs left out are queued again
+    results: List[JobUpdate] = []
+
+class JobRecord:
+    """Compact in-memory status of a job. Results are kept out of line (see queue.get_job_status)."""
+    __slots__ = ("job_id", "status", "message", "submitted_at")
+
+    def __init__(self, job_id: str, status: str, message: Optional[str] = None, submitted_at: float = 0.0):
+        self.job_id = job_id
+        self.status = status
+        self.message = message
+        self.submitted_at = submitted_at
+
+    def to_status(self, result: Optional[dict] = None) -> JobStatus:
+        return JobStatus(job_id=self.job_id, status=self.status, message=self.message, result=result)
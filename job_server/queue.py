@@ -1,30 +1,782 @@
+import os
+import sys
 import uuid
-from .models import JobPayload, JobStatus
-from typing import Dict, List, Tuple, Optional
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from .models import JobPayload, JobRecord, JobStatus
+from .store import JobStore, MemoryStore, open_store
+from .cache import CacheKey, ResultCache, cache_key
+from .reports import failed_tests_grep
+from . import durations, events, metrics
+from typing import Callable, Dict, List, Set, Tuple, Optional
 
-# Grouped job queue: (app_version_id, target) -> list of (job_id, JobPayload)
-job_groups: Dict[Tuple[str, str], List[Tuple[str, JobPayload]]] = {}
-jobs_status: Dict[str, JobStatus] = {}
+# Seconds of queue wait that count as much as one priority level. Older groups
+# therefore overtake newer, more urgent ones eventually and nothing starves.
+PRIORITY_AGING_SECONDS = float(os.environ.get("QGJOB_PRIORITY_AGING_SECONDS", "30"))
 
-def enqueue_job(job: JobPayload) -> str:
-    job_id = str(uuid.uuid4())
-    group_key = (job.app_version_id, job.target)
+# How groups are ordered within an org. "fifo": by age and priority only. "sjf": groups
+# expected to finish soonest go first, for lower average latency. "lpt": groups expected to
+# run longest go first, so short ones fill the gaps and all slots finish close together.
+# Expected run time comes from durations and counts as DURATION_WEIGHT seconds of waiting
+# per second, so aging still keeps any group from starving.
+DISPATCH_POLICY = os.environ.get("QGJOB_DISPATCH_POLICY", "fifo")
+DURATION_WEIGHT = float(os.environ.get("QGJOB_DURATION_WEIGHT", "1"))
+
+# Finished jobs are dropped from memory once there are more than RETAIN_FINISHED_JOBS
+# of them or they are older than RETAIN_FINISHED_SECONDS; the store still answers for them
+RETAIN_FINISHED_JOBS = int(os.environ.get("QGJOB_RETAIN_FINISHED_JOBS", "10000"))
+RETAIN_FINISHED_SECONDS = float(os.environ.get("QGJOB_RETAIN_FINISHED_SECONDS", "3600"))
+EVICTION_INTERVAL = float(os.environ.get("QGJOB_EVICTION_INTERVAL", "30"))
+
+def _parse_mapping(spec: str, cast=int) -> dict:
+    # "emulator=4,device=2" -> {"emulator": 4, "device": 2}
+    mapping = {}
+    for item in filter(None, spec.split(",")):
+        name, _, value = item.partition("=")
+        mapping[name.strip()] = cast(value)
+    return mapping
+
+# How many groups may run at once on each target; a target missing here gets DEFAULT_TARGET_SLOTS
+TARGET_SLOTS = _parse_mapping(os.environ.get("QGJOB_TARGET_SLOTS", "emulator=4,device=2,browserstack=5"))
+DEFAULT_TARGET_SLOTS = int(os.environ.get("QGJOB_DEFAULT_TARGET_SLOTS", "1"))
+
+def _positive_weight(name: str, weight: float) -> float:
+    # An org's virtual time advances by cost / weight, so a weight must be positive
+    if not weight > 0:
+        raise ValueError(f"org weight must be positive, got {name}={weight}")
+    return weight
+
+# Relative share of capacity per org_id when several orgs have work queued, e.g. "acme=2,globex=1"
+ORG_WEIGHTS = {org: _positive_weight(org, weight)
+               for org, weight in _parse_mapping(os.environ.get("QGJOB_ORG_WEIGHTS", ""), float).items()}
+DEFAULT_ORG_WEIGHT = _positive_weight("QGJOB_DEFAULT_ORG_WEIGHT", float(os.environ.get("QGJOB_DEFAULT_ORG_WEIGHT", "1")))
+
+# App affinity. A slot (a scheduler worker or a leasing agent) that just ran a build on a
+# target still has it installed and booted, so it is offered another group for the same
+# build and target first. That group must belong to the org whose turn it is under fair
+# share and be no more than AFFINITY_WINDOW seconds of rank behind the group it would get
+# otherwise (0 turns affinity off), so a priority level (PRIORITY_AGING_SECONDS) outweighs
+# it. Warm state expires WARM_STATE_TTL seconds after the slot last ran the build, or once
+# it has been reused WARM_STATE_MAX_REUSES times in a row (0: no limit), forcing a clean install.
+AFFINITY_WINDOW = float(os.environ.get("QGJOB_AFFINITY_WINDOW", "5"))
+WARM_STATE_TTL = float(os.environ.get("QGJOB_WARM_STATE_TTL", "600"))
+WARM_STATE_MAX_REUSES = int(os.environ.get("QGJOB_WARM_STATE_MAX_REUSES", "0"))
+# Estimated app install + device boot seconds per target, counted as saved on each warm reuse
+SETUP_SECONDS = _parse_mapping(os.environ.get("QGJOB_SETUP_SECONDS", "emulator=45,device=60,browserstack=20"), float)
+DEFAULT_SETUP_SECONDS = float(os.environ.get("QGJOB_DEFAULT_SETUP_SECONDS", "30"))
+
+# A job in one of these states will not change again
+TERMINAL_STATUSES = {"completed", "failed", "cancelled"}
+
+# (app_version_id, target, org_id). Index 0 and 1 are what jobs are grouped by; org_id
+# keeps tenants' jobs in separate groups so capacity can be shared between them. Shards
+# of a sharded job get "<app_version_id> shard i/N" so each shard can take its own slot
+GroupKey = Tuple[str, str, str]
+
+# Grouped job queue: group key -> list of queued (job_id, JobPayload). Claiming a group
+# detaches its list, so a list is only ever appended to while it's queued
+job_groups: Dict[GroupKey, List[Tuple[str, JobPayload]]] = {}
+jobs_status: Dict[str, JobRecord] = {}
+# Results live out of line: here only while the store can't serve them (memory backend, cache hits)
+job_results: Dict[str, dict] = {}
+# Finished job IDs in completion order -> monotonic finish time, for eviction
+finished_jobs: "OrderedDict[str, float]" = OrderedDict()
+
+# Persistence backend; init_store() swaps in the configured one at server startup
+store: JobStore = MemoryStore()
+
+# Groups currently claimed by a scheduler worker or agent lease -> the jobs detached with the
+# claim, which belong to the claimer. Jobs submitted for a claimed group queue up in
+# job_groups and are dispatched once the group is released, so a group never runs twice at once.
+active_groups: Dict[GroupKey, List[Tuple[str, JobPayload]]] = {}
+# target -> number of its slots held by claimed groups
+busy_slots: Dict[str, int] = {}
+_lock = threading.Lock()
+# Signalled whenever a group may have become available, so idle workers block instead of polling
+_group_available = threading.Condition(_lock)
+# The same signal for asyncio waiters (lease long-polls): an events key that is never a job ID
+GROUPS_CHANGED = "queue:groups"
+
+# Dispatch index: target -> org_id -> min-heap of (rank, seq, group_key), so targets whose
+# slots are all busy can be skipped without scanning their groups. A group's base rank is the
+# lowest rank of its queued jobs, where rank = enqueue time - priority * PRIORITY_AGING_SECONDS;
+# its rank is the base rank adjusted for its expected run time under DISPATCH_POLICY.
+# Because the aging term is folded into the enqueue time, ranks only change when jobs are
+# added and the heap stays valid without periodic rebuilds. Entries are invalidated
+# lazily: an entry is live only while it matches group_rank for a queued, idle group.
+group_rank: Dict[GroupKey, float] = {}
+group_base_rank: Dict[GroupKey, float] = {}
+# Sum of the expected run times of a group's queued jobs (not kept under "fifo")
+group_expected: Dict[GroupKey, float] = {}
+_group_heaps: Dict[str, Dict[str, List[Tuple[float, int, GroupKey]]]] = {}
+_seq = itertools.count()
+
+# Weighted fair queueing across orgs (start-time fair queueing): each dispatched group
+# advances its org's virtual time by jobs / weight, and the org with the lowest virtual
+# time goes next. Priority and aging order groups within an org. An org that becomes
+# active starts at the current virtual clock, so it can't bank credit while idle.
+org_vtime: Dict[str, float] = {}
+_virtual_clock = 0.0
+
+# Result cache and coalescing for use_cache jobs: the first of several identical jobs
+# (the leader) runs, the rest (followers) mirror its status transitions. Followers may
+# belong to other orgs, so when a leader is cancelled the first follower runs instead.
+result_cache = ResultCache()
+inflight: Dict[CacheKey, str] = {}
+leader_keys: Dict[str, CacheKey] = {}
+# Leader job ID -> (job_id, payload) of its followers, in submit order
+followers: Dict[str, List[Tuple[str, JobPayload]]] = {}
+
+# Sharded jobs: the parent job is never queued itself; its shard sub-jobs are, and the
+# parent's status follows them (running with the first, finished with the last)
+shard_children: Dict[str, List[str]] = {}
+shard_parents: Dict[str, str] = {}
+
+# Cancellation. A cancelled queued job stays in its group until the group is claimed and is
+# dropped then, so cancelling costs O(1). Listeners are called with each cancelled job ID,
+# e.g. to kill its process (the scheduler registers agent.cancel_run).
+cancel_listeners: List[Callable[[str], None]] = []
+# Jobs whose terminal status is being recorded. The first terminal transition of a job claims
+# it here under _lock, so a cancel racing with the run finishing can't both take effect
+_finishing: Set[str] = set()
+# Min-heap of (deadline as a time.time() value, job_id). The deadline checker sleeps until
+# the earliest one and is signalled when an earlier one is added
+_deadlines: List[Tuple[float, str]] = []
+_deadline_added = threading.Condition(_lock)
+# (org_id, branch) -> groups that jobs of that branch were queued in, for supersede
+branch_groups: Dict[Tuple[str, str], Set[GroupKey]] = {}
+
+# Slot ID -> [app_version_id, target, time.monotonic() it last ran them, reuses since installed]
+warm_slots: Dict[str, list] = {}
+# Claimed group -> the slot it runs on
+group_slots: Dict[GroupKey, str] = {}
+# (app_version_id, target) -> groups that jobs for that build were queued in. Pruned lazily
+app_groups: Dict[Tuple[str, str], Set[GroupKey]] = {}
+
+def init_store(backend: Optional[str] = None):
+    global store
+    store = open_store(backend) if backend else open_store()
+
+def job_rank(job: JobPayload, submitted_at: float) -> float:
+    return submitted_at - job.priority * PRIORITY_AGING_SECONDS
+
+def group_key_for(job: JobPayload) -> GroupKey:
+    if job.shard_index is None:
+        return (job.app_version_id, job.target, job.org_id)
+    return (f"{job.app_version_id} shard {job.shard_index}/{job.shards}", job.target, job.org_id)
+
+def shard_jobs(job_id: str, job: JobPayload) -> List[Tuple[str, JobPayload]]:
+    """The (job_id, payload) sub-jobs a sharded job is split into."""
+    return [(f"{job_id}-shard-{i}", job.model_copy(update={"shard_index": i})) for i in range(1, job.shards + 1)]
+
+def _link_shards_locked(job_id: str, shards: List[Tuple[str, JobPayload]]):
+    # Caller must hold _lock
+    shard_children[job_id] = [shard_id for shard_id, _ in shards]
+    for shard_id, _ in shards:
+        shard_parents[shard_id] = job_id
+
+def _track_deadline_locked(job_id: str, job: JobPayload, submitted_at: float):
+    # Caller must hold _lock. A sharded job's shards are cancelled along with it
+    if job.deadline is not None and job.shard_index is None:
+        heapq.heappush(_deadlines, (submitted_at + job.deadline, job_id))
+        if _deadlines[0][1] == job_id:
+            _deadline_added.notify()
+
+def _enqueue_locked(job_id: str, job: JobPayload, submitted_at: float, message: Optional[str] = None) -> JobRecord:
+    # Caller must hold _lock
+    if job.shards > 1 and job.shard_index is None:
+        shards = shard_jobs(job_id, job)
+        _link_shards_locked(job_id, shards)
+        for shard_id, shard in shards:
+            _enqueue_locked(shard_id, shard, submitted_at)
+        status = jobs_status[job_id] = JobRecord(job_id, "queued", message, submitted_at)
+        return status
+    group_key = group_key_for(job)
     if group_key not in job_groups:
         job_groups[group_key] = []
     job_groups[group_key].append((job_id, job))
-    jobs_status[job_id] = JobStatus(job_id=job_id, status="queued")
-    return job_id
+    if job.branch is not None:
+        branch_groups.setdefault((job.org_id, job.branch), set()).add(group_key)
+    app_groups.setdefault((job.app_version_id, job.target), set()).add(group_key)
+    status = jobs_status[job_id] = JobRecord(job_id, "queued", message, submitted_at)
+    group_base_rank[group_key] = min(job_rank(job, submitted_at), group_base_rank.get(group_key, float("inf")))
+    if DISPATCH_POLICY != "fifo":
+        group_expected[group_key] = group_expected.get(group_key, 0.0) + durations.expected(job)
+    rank = _policy_rank(group_key)
+    if rank != group_rank.get(group_key):
+        _push_group_locked(group_key, rank)
+    _group_available.notify()
+    return status
+
+def _policy_rank(group_key: GroupKey) -> float:
+    # Caller must hold _lock
+    rank = group_base_rank[group_key]
+    if DISPATCH_POLICY == "sjf":
+        return rank + group_expected[group_key] * DURATION_WEIGHT
+    if DISPATCH_POLICY == "lpt":
+        return rank - group_expected[group_key] * DURATION_WEIGHT
+    return rank
+
+def _push_group_locked(group_key: GroupKey, rank: float):
+    # Caller must hold _lock
+    group_rank[group_key] = rank
+    _, target, org = group_key
+    org_heaps = _group_heaps.setdefault(target, {})
+    if org not in org_heaps:
+        org_heaps[org] = []
+        org_vtime[org] = max(org_vtime.get(org, 0.0), _virtual_clock)
+    heapq.heappush(org_heaps[org], (rank, next(_seq), group_key))
+
+def org_weight(org: str) -> float:
+    return ORG_WEIGHTS.get(org, DEFAULT_ORG_WEIGHT)
+
+def free_slots(target: str) -> int:
+    return TARGET_SLOTS.get(target, DEFAULT_TARGET_SLOTS) - busy_slots.get(target, 0)
+
+def _admit_locked(job_id: str, job: JobPayload, submitted_at: float, key: Optional[CacheKey]) -> JobRecord:
+    # Caller must hold _lock
+    if key is not None:
+        cached = result_cache.get(key)
+        if cached is not None:
+            source_id, result = cached
+            job_results[job_id] = result
+            status = jobs_status[job_id] = JobRecord(
+                job_id, "completed", f"Reused the result of job {source_id} (cache hit).", submitted_at
+            )
+            _mark_finished_locked(job_id)
+            return status
+        _track_deadline_locked(job_id, job, submitted_at)
+        leader_id = inflight.get(key)
+        if leader_id is not None:
+            followers[leader_id].append((job_id, job))
+            status = jobs_status[job_id] = JobRecord(
+                job_id, "queued", f"Coalesced with identical job {leader_id}.", submitted_at
+            )
+            return status
+        inflight[key] = job_id
+        leader_keys[job_id] = key
+        followers[job_id] = []
+    else:
+        _track_deadline_locked(job_id, job, submitted_at)
+    return _enqueue_locked(job_id, job, submitted_at)
+
+def enqueue_job(job: JobPayload) -> str:
+    return enqueue_jobs([job])[0]
+
+def enqueue_jobs(jobs: List[JobPayload]) -> List[str]:
+    """Enqueue a batch of jobs under a single lock acquisition; they become visible to the scheduler together."""
+    submitted_at = time.time()
+    # Hash test files before taking the lock
+    records = [(str(uuid.uuid4()), job, cache_key(job) if job.use_cache else None) for job in jobs]
+    with _lock:
+        statuses = [_admit_locked(job_id, job, submitted_at, key) for job_id, job, key in records]
+        hits = [(status, job_results[status.job_id]) for status in statuses if status.job_id in job_results]
+        sharded = [(job_id, job) for job_id, job, _ in records if job_id in shard_children]
+        superseded = [
+            (obsolete_id, f"Superseded by app version {job.app_version_id} of branch {job.branch}.")
+            for _, job, _ in records if job.supersede and job.branch is not None
+            for obsolete_id in _superseded_locked(job)
+        ]
+    metrics.jobs_submitted.inc(len(records))
+    rows = [(job_id, job, submitted_at, status.status, status.message)
+            for (job_id, job, _), status in zip(records, statuses)]
+    for job_id, job in sharded:
+        rows.extend((shard_id, shard, submitted_at, "queued", None) for shard_id, shard in shard_jobs(job_id, job))
+    store.add_jobs(rows)
+    for status, result in hits:
+        store.update_status(status.job_id, status.status, status.message, result)
+    events.notify(GROUPS_CHANGED)
+    for job_id, message in superseded:
+        cancel_job(job_id, message)
+    return [job_id for job_id, _, _ in records]
+
+def _superseded_locked(job: JobPayload) -> List[str]:
+    # Caller must hold _lock. Queued jobs of the org's other builds of job.branch; for shards, their parent
+    obsolete = []
+    group_keys = branch_groups.get((job.org_id, job.branch), set())
+    for group_key in list(group_keys):
+        queued = job_groups.get(group_key)
+        if not queued:
+            group_keys.discard(group_key)
+            continue
+        for job_id, queued_job in queued:
+            if (queued_job.branch == job.branch and queued_job.app_version_id != job.app_version_id
+                    and jobs_status[job_id].status == "queued"):
+                # The leader's followers of this branch first, so none of them takes over its run
+                obsolete.extend(follower_id for follower_id, follower in followers.get(job_id, ())
+                                if follower.org_id == job.org_id and follower.branch == job.branch)
+                obsolete.append(shard_parents.get(job_id, job_id))
+    return list(dict.fromkeys(obsolete))
+
+def recover_jobs() -> int:
+    """Re-queue jobs that were queued or running when the server last stopped. Returns how many."""
+    unfinished = store.load_unfinished()
+    parents = []
+    for job_id, job, submitted_at, status in unfinished:
+        if job.shards > 1 and job.shard_index is None:
+            # Its unfinished shards are recovered from their own rows
+            with _lock:
+                jobs_status[job_id] = JobRecord(job_id, status, None, submitted_at)
+                _link_shards_locked(job_id, shard_jobs(job_id, job))
+                _track_deadline_locked(job_id, job, submitted_at)
+            parents.append(job_id)
+            continue
+        message = "Re-queued after server restart" if status == "running" else None
+        with _lock:
+            _track_deadline_locked(job_id, job, submitted_at)
+            _enqueue_locked(job_id, job, submitted_at, message)
+        if message:
+            store.update_status(job_id, "queued", message, None)
+            events.notify(job_id)
+    for job_id in parents:
+        # The server may have stopped after the last shard finished but before the parent did
+        _finish_sharded_job(job_id)
+    events.notify(GROUPS_CHANGED)
+    return len(unfinished)
 
 def get_job_status(job_id: str) -> JobStatus:
-    return jobs_status.get(job_id, JobStatus(job_id=job_id, status="not_found", message="Job not found"))
+    record = jobs_status.get(job_id)
+    if record is None:
+        # Evicted from memory (or from before a restart): ask the store
+        status = store.load_status(job_id)
+        return status or JobStatus(job_id=job_id, status="not_found", message="Job not found")
+    result = job_results.get(job_id)
+    if result is None and record.status in TERMINAL_STATUSES and store.keeps_results:
+        result = store.load_result(job_id)
+    return record.to_status(result)
+
+def list_jobs(filters: Dict[str, str], before: Optional[int] = None, limit: int = 100) -> Tuple[List[JobStatus], Optional[int]]:
+    """Newest first, up to limit jobs matching filters (without results), and the cursor to pass as
+    `before` for the next page (None on the last). Jobs submitted within the last store flush may be missing."""
+    matches = store.list_jobs(filters, before, limit + 1)
+    next_cursor = matches[limit - 1][0] if len(matches) > limit else None
+    statuses = []
+    for _, job_id, status, message in matches[:limit]:
+        # The store may not have committed the latest transition yet
+        record = jobs_status.get(job_id)
+        if record is not None:
+            status, message = record.status, record.message
+            if filters.get("status", status) != status:
+                continue
+        statuses.append(JobStatus(job_id=job_id, status=status, message=message))
+    return statuses, next_cursor
+
+def retry_failed_tests(job_id: str) -> Optional[str]:
+    """Submit a job that reruns only the tests that failed in job_id (a finished job). Returns the
+    new job's ID, or None if the job has no per-test results with failures."""
+    grep = failed_tests_grep((get_job_status(job_id).result or {}).get("tests"))
+    job = store.load_payload(job_id)
+    if grep is None or job is None:
+        return None
+    # A handful of tests needn't be sharded or cached, and mustn't cancel anything
+    retry = job.model_copy(update={
+        "grep": grep, "retry_of": job_id, "shards": 1, "shard_index": None, "use_cache": False, "supersede": False
+    })
+    return enqueue_job(retry)
+
+def _claim_transition_locked(job_id: str, status: str) -> bool:
+    # Caller must hold _lock. False if the job has finished or is finishing, so won't change again
+    record = jobs_status.get(job_id)
+    if job_id in _finishing or (record is not None and record.status in TERMINAL_STATUSES):
+        return False
+    if status in TERMINAL_STATUSES:
+        _finishing.add(job_id)
+    return True
+
+def update_job_status(job_id: str, status: str, message: Optional[str] = None, result: Optional[dict] = None) -> bool:
+    """Record a status transition for a job (and any jobs coalesced with it) and persist it.
+
+    A finished job keeps its status: e.g. later reports from a cancelled job's (killed) run
+    are ignored. Returns False if the transition was ignored for that reason.
+    Cancelling a leader doesn't cancel its followers; the first of them runs in its place.
+    """
+    successor = None
+    with _lock:
+        if not _claim_transition_locked(job_id, status):
+            return False
+        coalesced = followers.get(job_id, [])
+        if status in TERMINAL_STATUSES and job_id in leader_keys:
+            key = leader_keys.pop(job_id)
+            inflight.pop(key, None)
+            followers.pop(job_id, None)
+            if status == "completed" and result is not None:
+                result_cache.put(key, job_id, result)
+            if status == "cancelled":
+                if coalesced:
+                    successor = _promote_follower_locked(key, coalesced)
+                coalesced = []
+        # Followers cancelled in the meantime keep that status
+        coalesced = [(follower_id, follower) for follower_id, follower in coalesced
+                     if _claim_transition_locked(follower_id, status)]
+        parent_id = shard_parents.get(job_id)
+    _apply_status(job_id, status, message, result)
+    for follower_id, _ in coalesced:
+        _apply_status(follower_id, status, f"Coalesced with job {job_id}: {message}" if message else None, result)
+    if successor is not None:
+        successor_id, successor_job = successor
+        if successor_id in shard_children:
+            store.add_jobs([(shard_id, shard, jobs_status[successor_id].submitted_at, "queued", None)
+                            for shard_id, shard in shard_jobs(successor_id, successor_job)])
+        # Its own followers mirror this too
+        update_job_status(successor_id, "queued", f"Runs in place of cancelled job {job_id}.")
+        events.notify(GROUPS_CHANGED)
+    if parent_id is None:
+        return True
+    if status == "running" and jobs_status[parent_id].status == "queued":
+        update_job_status(parent_id, "running", "Shards started running.")
+    elif status in TERMINAL_STATUSES:
+        _finish_sharded_job(parent_id)
+    return True
+
+def _promote_follower_locked(key: CacheKey, coalesced: List[Tuple[str, JobPayload]]) -> Tuple[str, JobPayload]:
+    # Caller must hold _lock. Makes the first follower the leader for key and queues it
+    (leader_id, job), rest = coalesced[0], coalesced[1:]
+    inflight[key] = leader_id
+    leader_keys[leader_id] = key
+    followers[leader_id] = rest
+    _enqueue_locked(leader_id, job, jobs_status[leader_id].submitted_at, jobs_status[leader_id].message)
+    return leader_id, job
+
+def is_cancelled(job_id: str) -> bool:
+    record = jobs_status.get(job_id)
+    return record is not None and record.status == "cancelled"
+
+def cancel_job(job_id: str, message: str = "Cancelled.") -> bool:
+    """Cancel a job that hasn't finished: a queued job never runs, a running one is stopped.
+
+    Cancelling a sharded job cancels its shards; a job coalesced with it runs instead (see
+    update_job_status). Returns False if the job is unknown or has already finished.
+    """
+    with _lock:
+        record = jobs_status.get(job_id)
+        if record is None or record.status in TERMINAL_STATUSES or job_id in _finishing:
+            return False
+        for coalesced in followers.values():
+            if any(follower_id == job_id for follower_id, _ in coalesced):
+                coalesced[:] = [follower for follower in coalesced if follower[0] != job_id]
+                break
+        shard_ids = list(shard_children.get(job_id, ()))
+    if not update_job_status(job_id, "cancelled", message):
+        # Its run finished first
+        return False
+    for shard_id in shard_ids:
+        cancel_job(shard_id, message)
+    for listener in cancel_listeners:
+        listener(job_id)
+    return True
+
+def cancel_overdue_jobs() -> int:
+    """Cancel jobs whose deadline has passed. Returns how many were cancelled."""
+    now = time.time()
+    with _lock:
+        overdue = []
+        while _deadlines and _deadlines[0][0] <= now:
+            overdue.append(heapq.heappop(_deadlines)[1])
+    return sum(cancel_job(job_id, "Cancelled: deadline exceeded.") for job_id in overdue)
+
+def start_deadline_checks():
+    def deadline_loop():
+        while True:
+            # Idle (no timed wakeups) while no job has a deadline
+            with _lock:
+                while not _deadlines or _deadlines[0][0] > time.time():
+                    _deadline_added.wait(_deadlines[0][0] - time.time() if _deadlines else None)
+            cancel_overdue_jobs()
+    threading.Thread(target=deadline_loop, name="job-deadlines", daemon=True).start()
+
+def _finish_sharded_job(job_id: str):
+    # Once every shard has finished, complete the parent with the merged shard results
+    with _lock:
+        shard_ids = shard_children.get(job_id)
+        if shard_ids is None or any(shard_id in jobs_status and jobs_status[shard_id].status not in TERMINAL_STATUSES
+                                    for shard_id in shard_ids):
+            return
+        # Whoever gets here first finishes the parent
+        del shard_children[job_id]
+        for shard_id in shard_ids:
+            shard_parents.pop(shard_id, None)
+    shards = [get_job_status(shard_id) for shard_id in shard_ids]
+    failed = [shard for shard in shards if shard.status != "completed"]
+    results = [shard.result or {} for shard in shards]
+    result = {
+        "exit_code": next(((shard.result or {}).get("exit_code") or 1 for shard in failed), 0),
+        "shards": [
+            {"job_id": shard.job_id, "status": shard.status, "exit_code": r.get("exit_code"), "log_path": r.get("log_path")}
+            for shard, r in zip(shards, results)
+        ],
+    }
+    tests = [r["tests"] for r in results if r.get("tests")]
+    if tests:
+        result["tests"] = {
+            "passed": sum(t["passed"] for t in tests),
+            "failed": sum(t["failed"] for t in tests),
+            "skipped": sum(t["skipped"] for t in tests),
+            "ok": all(t["ok"] for t in tests),
+            "results": [record for t in tests for record in t.get("results", [])],
+        }
+    merged_artifacts = {}
+    for r in results:
+        merged_artifacts.update(r.get("artifacts") or {})
+    if merged_artifacts:
+        result["artifacts"] = merged_artifacts
+    if failed:
+        update_job_status(job_id, "failed", f"{len(failed)} of {len(shards)} shards failed.", result)
+    else:
+        update_job_status(job_id, "completed", f"All {len(shards)} shards passed.", result)
+
+def _apply_status(job_id: str, status: str, message: Optional[str], result: Optional[dict]):
+    # The store gets the result before the record turns terminal, so readers never see a gap
+    record = jobs_status[job_id]
+    message = record.message if message is None else message
+    store.update_status(job_id, status, message, result)
+    if status == "running" and record.status == "queued":
+        metrics.queue_wait.observe(time.time() - record.submitted_at)
+    with _lock:
+        if result is not None and not store.keeps_results:
+            job_results[job_id] = result
+        record.status = sys.intern(status)
+        record.message = message
+        if status in TERMINAL_STATUSES:
+            _finishing.discard(job_id)
+            _mark_finished_locked(job_id)
+    events.notify(job_id)
 
-def get_next_group() -> Optional[Tuple[Tuple[str, str], List[Tuple[str, JobPayload]]]]:
-    """Return the next group (app_version_id, target) and its jobs, or None if empty."""
-    for group_key, jobs in job_groups.items():
-        if jobs:
-            return group_key, jobs
+def _mark_finished_locked(job_id: str):
+    # Caller must hold _lock
+    finished_jobs[job_id] = time.monotonic()
+    finished_jobs.move_to_end(job_id)
+    if len(finished_jobs) > RETAIN_FINISHED_JOBS:
+        _evict_locked(finished_jobs.popitem(last=False)[0])
+
+def _evict_locked(job_id: str):
+    # Caller must hold _lock
+    jobs_status.pop(job_id, None)
+    job_results.pop(job_id, None)
+    events.forget([job_id])
+    store.forget(job_id)
+
+def evict_finished_jobs() -> int:
+    """Drop finished jobs older than RETAIN_FINISHED_SECONDS from memory. Returns how many were evicted."""
+    cutoff = time.monotonic() - RETAIN_FINISHED_SECONDS
+    evicted = 0
+    with _lock:
+        while finished_jobs:
+            job_id, finished_at = next(iter(finished_jobs.items()))
+            if finished_at >= cutoff:
+                break
+            del finished_jobs[job_id]
+            _evict_locked(job_id)
+            evicted += 1
+    return evicted
+
+def start_eviction():
+    def eviction_loop():
+        while True:
+            time.sleep(EVICTION_INTERVAL)
+            evict_finished_jobs()
+    threading.Thread(target=eviction_loop, name="job-eviction", daemon=True).start()
+
+def _warm_state_locked(slot: str) -> Optional[list]:
+    # Caller must hold _lock. The slot's warm state, unless it has expired
+    warm = warm_slots.get(slot)
+    if warm is not None and (time.monotonic() - warm[2] > WARM_STATE_TTL
+                             or (WARM_STATE_MAX_REUSES and warm[3] >= WARM_STATE_MAX_REUSES)):
+        del warm_slots[slot]
+        return None
+    return warm
+
+def _warm_group_locked(slot: str, targets: Optional[List[str]], org: str, best_rank: float) -> Optional[GroupKey]:
+    # Caller must hold _lock. The most urgent idle group of org for the build warm on slot, if
+    # it is within AFFINITY_WINDOW of best_rank. Costs O(groups queued for that build).
+    warm = _warm_state_locked(slot)
+    if warm is None:
+        return None
+    app_version_id, target = warm[0], warm[1]
+    if (targets is not None and target not in targets) or free_slots(target) <= 0:
+        return None
+    group_keys = app_groups.get((app_version_id, target), set())
+    found = None
+    for group_key in list(group_keys):
+        if not job_groups.get(group_key):
+            group_keys.discard(group_key)
+        elif (group_key[2] == org and group_key not in active_groups
+              and (found is None or group_rank[group_key] < group_rank[found])):
+            found = group_key
+    if not group_keys:
+        app_groups.pop((app_version_id, target), None)
+    if found is not None and group_rank[found] <= best_rank + AFFINITY_WINDOW:
+        return found
     return None
 
-def remove_group(group_key: Tuple[str, str]):
-    if group_key in job_groups:
-        del job_groups[group_key] 
\ No newline at end of file
+def _warm_up_locked(slot: str, app_version_id: str, target: str):
+    # Caller must hold _lock. Records that slot now runs the build, counting a warm reuse
+    warm = _warm_state_locked(slot)
+    if warm is not None and warm[0] == app_version_id and warm[1] == target:
+        warm[3] += 1
+        metrics.warm_reuses.inc()
+        metrics.setup_seconds_saved.inc(SETUP_SECONDS.get(target, DEFAULT_SETUP_SECONDS))
+    else:
+        warm_slots[slot] = [app_version_id, target, time.monotonic(), 0]
+
+def _claim_next_group(targets: Optional[List[str]] = None,
+                      slot: Optional[str] = None) -> Optional[Tuple[GroupKey, List[Tuple[str, JobPayload]]]]:
+    # Caller must hold _lock. Among targets with a free slot, picks the org with the lowest
+    # virtual time and takes its lowest-ranked group, unless the claiming slot has a build
+    # warm that another group of that org could use. Costs O(targets * active orgs + log n).
+    global _virtual_clock
+    while True:
+        best = None
+        for target, org_heaps in _group_heaps.items():
+            if (targets is not None and target not in targets) or free_slots(target) <= 0:
+                continue
+            for org, heap in list(org_heaps.items()):
+                while heap and (group_rank.get(heap[0][2]) != heap[0][0] or heap[0][2] in active_groups
+                                or not job_groups.get(heap[0][2])):
+                    heapq.heappop(heap)  # stale entry
+                if not heap:
+                    del org_heaps[org]
+                    continue
+                candidate = (org_vtime[org], heap[0][0], target, org)
+                if best is None or candidate < best:
+                    best = candidate
+        if best is None:
+            return None
+        vtime, rank, target, org = best
+        _virtual_clock = vtime
+        group_key = _warm_group_locked(slot, targets, org, rank) if slot is not None and AFFINITY_WINDOW > 0 else None
+        if group_key is None:
+            _, _, group_key = heapq.heappop(_group_heaps[target][org])
+        else:
+            # Its heap entry goes stale with group_rank below
+            target = group_key[1]
+        del group_rank[group_key]
+        group_base_rank.pop(group_key, None)
+        group_expected.pop(group_key, None)
+        # Detach the queued jobs: later submissions start a new list, so nothing is appended
+        # to what the claimer runs. Cancelled jobs are dropped here rather than when cancelled.
+        jobs = [(job_id, job) for job_id, job in job_groups.pop(group_key)
+                if job_id in jobs_status and jobs_status[job_id].status not in TERMINAL_STATUSES]
+        if not jobs:
+            continue
+        org_vtime[org] += len(jobs) / org_weight(org)
+        active_groups[group_key] = jobs
+        busy_slots[target] = busy_slots.get(target, 0) + 1
+        if slot is not None:
+            group_slots[group_key] = slot
+            _warm_up_locked(slot, jobs[0][1].app_version_id, target)
+        return group_key, jobs
+
+def _release_slot_locked(group_key: GroupKey):
+    # Caller must hold _lock
+    if active_groups.pop(group_key, None) is None:
+        return
+    busy_slots[group_key[1]] -= 1
+    slot = group_slots.pop(group_key, None)
+    if slot in warm_slots:
+        # Warm state ages from when the slot stopped using the build
+        warm_slots[slot][2] = time.monotonic()
+    if job_groups.get(group_key):
+        # Jobs submitted while the group ran: their heap entry was skipped as active, so add it again
+        _push_group_locked(group_key, group_rank[group_key])
+    # Waiters may be limited to different targets, so wake them all
+    _group_available.notify_all()
+
+def get_next_group(block: bool = False, timeout: Optional[float] = None, targets: Optional[List[str]] = None,
+                   slot: Optional[str] = None) -> Optional[Tuple[GroupKey, List[Tuple[str, JobPayload]]]]:
+    """Claim the next idle group and its jobs, or None if empty.
+
+    Orgs share capacity by weight; within an org the most urgent group goes first. Only
+    targets with a free slot are considered (and only `targets`, if given). A claimer that
+    names its `slot` is preferably given groups for the build it ran last. A claimed group
+    holds one slot of its target and is skipped by other workers until remove_group (or
+    requeue_group) is called for it. With block=True, wait up to timeout seconds (forever if None)
+    until enqueue_job or a freed slot signals new work (or wake_waiters is called).
+    Async callers wait with events.wait_for_change on GROUPS_CHANGED instead of blocking.
+    """
+    with _lock:
+        group = _claim_next_group(targets, slot)
+        if group is None and block:
+            _group_available.wait(timeout)
+            group = _claim_next_group(targets, slot)
+        return group
+
+def wake_waiters():
+    """Wake every worker blocked in get_next_group, e.g. so it can notice shutdown."""
+    with _lock:
+        _group_available.notify_all()
+    events.notify(GROUPS_CHANGED)
+
+def remove_group(group_key: GroupKey):
+    """Release a group claimed with get_next_group once its jobs have run, freeing its slot.
+
+    Jobs submitted for the group after it was claimed stay queued and can be claimed next.
+    """
+    with _lock:
+        _release_slot_locked(group_key)
+    events.notify(GROUPS_CHANGED)
+
+def requeue_group(group_key: GroupKey, jobs: List[Tuple[str, JobPayload]], message: str) -> List[str]:
+    """Hand a claimed group back to the queue, e.g. when its agent's lease expired.
+
+    jobs are the ones get_next_group returned for it. Those that haven't finished are queued
+    again, with their original priority and ahead of any submitted since; returns their IDs.
+    """
+    with _lock:
+        if group_key not in active_groups:
+            return []
+        # Evicted jobs are finished jobs
+        unfinished = [(job_id, job) for job_id, job in jobs if job_id in jobs_status and job_id not in _finishing
+                      and jobs_status[job_id].status not in TERMINAL_STATUSES]
+        if unfinished:
+            job_groups[group_key] = unfinished + job_groups.get(group_key, [])
+            app_groups.setdefault((unfinished[0][1].app_version_id, group_key[1]), set()).add(group_key)
+            group_base_rank[group_key] = min(
+                group_base_rank.get(group_key, float("inf")),
+                min(job_rank(job, jobs_status[job_id].submitted_at) for job_id, job in unfinished)
+            )
+            if DISPATCH_POLICY != "fifo":
+                group_expected[group_key] = (group_expected.get(group_key, 0.0)
+                                             + sum(durations.expected(job) for _, job in unfinished))
+            group_rank[group_key] = _policy_rank(group_key)
+        # Pushes the group back onto the dispatch heap
+        _release_slot_locked(group_key)
+        pending = [job_id for job_id, _ in unfinished]
+    for job_id in pending:
+        _apply_status(job_id, "queued", message, None)
+    events.notify(GROUPS_CHANGED)
+    return pending
+
+def reset_queue():
+    """Drop every queued group and job status (used by the benchmarks)."""
+    global _virtual_clock
+    with _lock:
+        _virtual_clock = 0.0
+        events.forget(list(jobs_status))
+        for job_id in jobs_status:
+            store.forget(job_id)
+        job_groups.clear()
+        jobs_status.clear()
+        job_results.clear()
+        finished_jobs.clear()
+        active_groups.clear()
+        busy_slots.clear()
+        group_rank.clear()
+        group_base_rank.clear()
+        group_expected.clear()
+        _group_heaps.clear()
+        org_vtime.clear()
+        result_cache.clear()
+        inflight.clear()
+        leader_keys.clear()
+        followers.clear()
+        shard_children.clear()
+        shard_parents.clear()
+        _deadlines.clear()
+        _finishing.clear()
+        branch_groups.clear()
+        warm_slots.clear()
+        group_slots.clear()
+        app_groups.clear()
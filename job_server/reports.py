@@ -0,0 +1,112 @@
+import json
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Set
+
+# Error messages in per-test results are cut to their first lines, at most this many characters
+ERROR_SUMMARY_CHARS = 300
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
+# Characters to escape so a title matches itself in a JavaScript regular expression
+REGEX_SPECIAL = re.compile(r"[.*+?^${}()|[\]\\/]")
+# Playwright's per-test outcome -> ours
+TEST_STATUSES = {"expected": "passed", "unexpected": "failed", "flaky": "flaky", "skipped": "skipped"}
+
+def load_report(path: str) -> Optional[dict]:
+    """Load a Playwright JSON reporter file, or None if the run didn't produce one."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _normalize(path: str) -> str:
+    return os.path.normpath(path).replace("\\", "/")
+
+def _walk_specs(suite: dict, titles=()):
+    # Yields (titles of the describe blocks around the spec, spec)
+    for spec in suite.get("specs", []):
+        yield titles, spec
+    for child in suite.get("suites", []):
+        yield from _walk_specs(child, (*titles, child["title"]))
+
+def _error_summary(results: List[dict]) -> Optional[str]:
+    # The last attempt's first error, without colour codes
+    for result in reversed(results):
+        errors = result.get("errors") or ([result["error"]] if result.get("error") else [])
+        message = next((error.get("message") for error in errors if error.get("message")), None)
+        if message:
+            message = ANSI_ESCAPE.sub("", message).strip()
+            lines = [line.strip() for line in message.splitlines() if line.strip()]
+            return " ".join(lines[:3])[:ERROR_SUMMARY_CHARS]
+    return None
+
+def file_summaries(report: dict) -> Dict[str, dict]:
+    """Per spec file (as Playwright names it, relative to testDir): pass/fail counts, run time, whether
+    it passed, and per test ("results") its title, status, duration and error summary."""
+    summaries = {}
+    for suite in report.get("suites", []):
+        summary = summaries.setdefault(
+            _normalize(suite["file"]), {"passed": 0, "failed": 0, "skipped": 0, "duration": 0.0, "results": []}
+        )
+        for titles, spec in _walk_specs(suite):
+            for test in spec.get("tests", []):
+                results = test.get("results", [])
+                # Seconds spent in the test, retries included
+                duration = sum(result.get("duration", 0) for result in results) / 1000
+                summary["duration"] += duration
+                # Per test, i.e. per project: a spec's "ok" covers every project it ran in
+                if test.get("status") == "skipped":
+                    summary["skipped"] += 1
+                elif test.get("status") in ("expected", "flaky"):
+                    summary["passed"] += 1
+                else:
+                    summary["failed"] += 1
+                # Titles are joined with spaces, as Playwright does when matching --grep
+                record = {
+                    "title": " ".join((*titles, spec["title"])),
+                    "status": TEST_STATUSES.get(test.get("status"), test.get("status")),
+                    "duration": round(duration, 3),
+                }
+                if test.get("projectName"):
+                    record["project"] = test["projectName"]
+                if record["status"] in ("failed", "flaky"):
+                    record["error"] = _error_summary(results)
+                summary["results"].append(record)
+    for summary in summaries.values():
+        summary["ok"] = summary["failed"] == 0
+    return summaries
+
+def file_output_dirs(report: dict, output_dir: str) -> Dict[str, Set[str]]:
+    """Per spec file: the test output directories (top level of Playwright's --output) its attachments are in."""
+    output_dir = os.path.abspath(output_dir)
+    dirs = {}
+    for suite in report.get("suites", []):
+        file_dirs = dirs.setdefault(_normalize(suite["file"]), set())
+        for _, spec in _walk_specs(suite):
+            for test in spec.get("tests", []):
+                for result in test.get("results", []):
+                    for attachment in result.get("attachments", []):
+                        path = attachment.get("path")
+                        if path and os.path.abspath(path).startswith(output_dir + os.sep):
+                            file_dirs.add(_normalize(os.path.relpath(path, output_dir)).split("/")[0])
+    return dirs
+
+def match_file(test_path: str, files: Iterable[str]) -> Optional[str]:
+    """Find the report entry for a submitted test path (report paths are relative to testDir)."""
+    test_path = _normalize(test_path)
+    for name in files:
+        if test_path == name or test_path.endswith("/" + name):
+            return name
+    return None
+
+def failed_tests_grep(tests: Optional[dict]) -> Optional[str]:
+    """A --grep pattern for the failed tests in a file summary, or None if none failed."""
+    titles = list(dict.fromkeys(
+        record["title"] for record in (tests or {}).get("results", []) if record["status"] == "failed"
+    ))
+    if not titles:
+        return None
+    # Playwright matches against "<project> <file> <describes> <title> <tags>". Anchor each title to
+    # the end (bar tags) and a space, so a failed "login" doesn't also rerun "login fails" or "relogin"
+    alternatives = "|".join(REGEX_SPECIAL.sub(r"\\\g<0>", title) for title in titles)
+    return f"(?:^| )(?:{alternatives})(?: @\\S+)*$"
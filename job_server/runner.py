@@ -0,0 +1,135 @@
+import asyncio
+import os
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Set
+from job_server import metrics
+
+# Per-job log files are written here; only a bounded tail of each stream is kept in memory
+LOG_DIR = os.environ.get("QGJOB_LOG_DIR", "job_logs")
+TAIL_BYTES = int(os.environ.get("QGJOB_LOG_TAIL_BYTES", "8192"))
+READ_CHUNK_BYTES = 64 * 1024
+
+class TailBuffer:
+    """Keeps only the last max_bytes written to it."""
+
+    def __init__(self, max_bytes: int = TAIL_BYTES):
+        self.max_bytes = max_bytes
+        self._chunks: deque = deque()
+        self._size = 0
+
+    def write(self, data: bytes):
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            excess = self._size - self.max_bytes
+            head = self._chunks[0]
+            if len(head) <= excess:
+                self._chunks.popleft()
+                self._size -= len(head)
+            else:
+                self._chunks[0] = head[excess:]
+                self._size -= excess
+
+    def getvalue(self) -> str:
+        return b"".join(self._chunks).decode("utf-8", errors="replace")
+
+# One event loop, on its own thread, supervises every running subprocess
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="runner-loop", daemon=True).start()
+        return _loop
+
+async def _pump(stream: asyncio.StreamReader, log_file, tail: TailBuffer):
+    while True:
+        chunk = await stream.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        log_file.write(chunk)
+        tail.write(chunk)
+
+# Running processes by run ID, so they can be killed from other threads
+_processes: Dict[str, asyncio.subprocess.Process] = {}
+# Runs killed before their process was registered; killed as soon as it is. Like _processes,
+# only touched on the runner loop
+_pending_kills: Set[str] = set()
+
+def _kill_tree(process: asyncio.subprocess.Process):
+    # npx starts Node, which starts browsers and Playwright workers: take the whole tree down
+    if process.returncode is not None:
+        return
+    if os.name == "nt":
+        subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], capture_output=True)
+        return
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+async def run_command(command: List[str], log_path: str, timeout: float, env: Optional[Dict[str, str]] = None,
+                      run_id: Optional[str] = None) -> dict:
+    """Run command, streaming stdout and stderr into log_path. Returns exit code and output tails."""
+    os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+    stdout_tail, stderr_tail = TailBuffer(), TailBuffer()
+    with open(log_path, "wb") as log_file:
+        spawn_started = time.perf_counter()
+        # Its own process group (POSIX), so the tree can be killed as one
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            env={**os.environ, **env} if env else None, start_new_session=os.name != "nt"
+        )
+        metrics.spawn_time.observe(time.perf_counter() - spawn_started)
+        if run_id is not None:
+            _processes[run_id] = process
+            if run_id in _pending_kills:
+                _kill_tree(process)
+        try:
+            await asyncio.wait_for(asyncio.gather(
+                _pump(process.stdout, log_file, stdout_tail),
+                _pump(process.stderr, log_file, stderr_tail),
+                process.wait(),
+            ), timeout)
+        except asyncio.TimeoutError:
+            _kill_tree(process)
+            await process.wait()
+            raise TimeoutError(f"timed out after {timeout} seconds")
+        finally:
+            if run_id is not None:
+                _processes.pop(run_id, None)
+                _pending_kills.discard(run_id)
+    return {
+        "stdout": stdout_tail.getvalue(),
+        "stderr": stderr_tail.getvalue(),
+        "exit_code": process.returncode,
+        "log_path": log_path,
+    }
+
+def run_job(run_id: str, command: List[str], timeout: float, env: Optional[Dict[str, str]] = None) -> dict:
+    """Run a command on the shared event loop and block the calling thread until it exits.
+
+    Output goes to LOG_DIR/<run_id>.log; run_id is the job ID, or a group run ID for group execution.
+    """
+    log_path = os.path.join(LOG_DIR, f"{run_id}.log")
+    future = asyncio.run_coroutine_threadsafe(run_command(command, log_path, timeout, env, run_id), get_loop())
+    return future.result()
+
+def _kill(run_id: str):
+    process = _processes.get(run_id)
+    if process is None:
+        # Not started yet
+        _pending_kills.add(run_id)
+    else:
+        _kill_tree(process)
+
+def kill_job(run_id: str):
+    """Kill the process tree of a run started by run_job, even one that hasn't started yet; run_job then returns."""
+    get_loop().call_soon_threadsafe(_kill, run_id)
@@ -1,22 +1,71 @@
+import os
 import threading
 import time
-from job_server.queue import get_next_group, remove_group
-from job_server.agent import run_group
+import traceback
+from typing import List, Optional, Tuple
+from job_server.queue import (
+    TARGET_SLOTS, TERMINAL_STATUSES, cancel_listeners, get_job_status, get_next_group, remove_group, update_job_status,
+    wake_waiters
+)
+from job_server.agent import cancel_run, run_group
+from job_server.models import JobPayload
+from job_server import metrics
+
+# Number of local worker threads. By default there is one per target slot, so every free
+# slot is filled right away; the slot counts themselves keep each target from being
+# oversubscribed. Jobs inside a group still run in order.
+SCHEDULER_WORKERS = int(os.environ.get("QGJOB_SCHEDULER_WORKERS", sum(TARGET_SLOTS.values())))
 
 scheduler_running = False
+_workers: List[threading.Thread] = []
 
 def scheduler_loop():
-    global scheduler_running
-    scheduler_running = True
+    # Each worker is a slot for app affinity: it gets groups for the build it ran last first
+    slot = threading.current_thread().name
     while scheduler_running:
-        group = get_next_group()
+        # Blocks until enqueue_job signals new work, so an idle server doesn't poll
+        waiting_since = time.perf_counter()
+        group = get_next_group(block=True, slot=slot)
+        metrics.scheduler_idle.inc(time.perf_counter() - waiting_since)
+        metrics.scheduler_iterations.inc()
         if group:
             group_key, jobs = group
-            run_group(group_key, jobs)
-            remove_group(group_key)
-        else:
-            time.sleep(1)  # Wait before checking again
+            try:
+                run_group(group_key, jobs)
+            except Exception as e:
+                # Keep the worker alive; jobs the group left unfinished would otherwise stay "running"
+                print(f"Running group {group_key} failed: {e}")
+                traceback.print_exc()
+                _fail_unfinished(jobs, e)
+            finally:
+                remove_group(group_key)
+
+def _fail_unfinished(jobs: List[Tuple[str, JobPayload]], error: Exception):
+    for job_id, _ in jobs:
+        if get_job_status(job_id).status not in TERMINAL_STATUSES:
+            update_job_status(
+                job_id, "failed", message=f"Job {job_id} failed to run: {error}",
+                result={"stdout": "", "stderr": str(error), "exit_code": -1}
+            )
 
-def start_scheduler():
-    t = threading.Thread(target=scheduler_loop, daemon=True)
-    t.start() 
\ No newline at end of file
+def start_scheduler(workers: Optional[int] = None):
+    global scheduler_running
+    scheduler_running = True
+    # Cancelling a job that runs here kills its Playwright process
+    if cancel_run not in cancel_listeners:
+        cancel_listeners.append(cancel_run)
+    # 0 workers leaves all execution to remote agents leasing groups over the API
+    for i in range(SCHEDULER_WORKERS if workers is None else workers):
+        t = threading.Thread(target=scheduler_loop, name=f"scheduler-{i}", daemon=True)
+        t.start()
+        _workers.append(t)
+
+def stop_scheduler():
+    global scheduler_running
+    scheduler_running = False
+    for t in _workers:
+        # A worker may check the flag just before blocking, so keep waking until it exits
+        while t.is_alive():
+            wake_waiters()
+            t.join(0.1)
+    _workers.clear()
@@ -0,0 +1,66 @@
+"""
+Run the API in several worker processes that share one listening socket:
+
+    python -m job_server.serve --workers 4 --port 8000
+
+Like `uvicorn job_server.main:app --workers N`, except that the socket is explicitly a TCP
+socket. uvicorn's shared socket isn't, so asyncio never turns on TCP_NODELAY for its
+connections and every small response waits ~40 ms for a delayed ACK. Workers that exit
+are restarted. See job_server/cluster.py for how the workers share the queue.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import uvicorn
+
+def _serve(sock: socket.socket, log_level: str):
+    uvicorn.Server(uvicorn.Config("job_server.main:app", log_level=log_level)).run(sockets=[sock])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    family = socket.AF_INET6 if ":" in args.host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.set_inheritable(True)
+
+    # Turns on the primary election in the workers (see job_server/cluster.py)
+    os.environ["QGJOB_API_WORKERS"] = str(args.workers)
+    context = multiprocessing.get_context("spawn")
+
+    def start_worker():
+        process = context.Process(target=_serve, args=(sock, args.log_level), name="qgjob-api")
+        process.start()
+        return process
+
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    workers = [start_worker() for _ in range(args.workers)]
+    while not stopping:
+        time.sleep(0.5)
+        for i, process in enumerate(workers):
+            if not stopping and not process.is_alive():
+                print(f"API worker {process.pid} exited with code {process.exitcode}; restarting it")
+                workers[i] = start_worker()
+    for process in workers:
+        process.terminate()
+    for process in workers:
+        process.join()
+
+if __name__ == "__main__":
+    main()
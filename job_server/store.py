@@ -0,0 +1,352 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left, insort
+from typing import Dict, List, Optional, Tuple
+from job_server.models import JobPayload, JobStatus
+
+# Which backend persists jobs: "sqlite" (default) or "memory" (nothing survives a restart)
+STORE_BACKEND = os.environ.get("QGJOB_STORE", "sqlite")
+DB_PATH = os.environ.get("QGJOB_DB_PATH", "qgjob.db")
+# Group commit: writes are collected for up to this long (or MAX_BATCH rows) and committed together
+FLUSH_INTERVAL = float(os.environ.get("QGJOB_STORE_FLUSH_MS", "20")) / 1000
+MAX_BATCH = 1000
+# Seconds to wait before retrying a batch whose commit failed (e.g. database locked, disk full)
+WRITE_RETRY_INTERVAL = 1.0
+
+class JobStore(ABC):
+    """Persistence backend for submitted jobs and their statuses.
+
+    The queue keeps its dispatch index in memory; the store is what lets it be rebuilt after a restart.
+    """
+
+    # Whether load_result can serve results, so the queue needn't keep them in memory
+    keeps_results = False
+
+    def add_job(self, job_id: str, job: JobPayload, submitted_at: float, status: str, message: Optional[str] = None):
+        self.add_jobs([(job_id, job, submitted_at, status, message)])
+
+    @abstractmethod
+    def add_jobs(self, jobs: List[Tuple[str, JobPayload, float, str, Optional[str]]]):
+        """Persist (job_id, payload, submitted_at, status, message) rows; a batch is committed together."""
+
+    @abstractmethod
+    def update_status(self, job_id: str, status: str, message: Optional[str], result: Optional[dict]):
+        ...
+
+    @abstractmethod
+    def load_status(self, job_id: str) -> Optional[JobStatus]:
+        ...
+
+    @abstractmethod
+    def load_result(self, job_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def load_payload(self, job_id: str) -> Optional[JobPayload]:
+        ...
+
+    @abstractmethod
+    def load_unfinished(self) -> List[Tuple[str, JobPayload, float, str]]:
+        """Return (job_id, payload, submitted_at, status) for queued and running jobs, in submit order."""
+
+    @abstractmethod
+    def list_jobs(self, filters: Dict[str, str], before: Optional[int] = None,
+                  limit: int = 100) -> List[Tuple[int, str, str, Optional[str]]]:
+        """Newest first, up to limit (cursor, job_id, status, message) rows for the jobs matching every
+        filter (org_id, app_version_id, target, status), submitted before the job at cursor `before`.
+        Writes not yet committed may be missing."""
+
+    def forget(self, job_id: str):
+        """Called when the queue drops a finished job from memory."""
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+# Fields jobs can be listed by
+LIST_FILTERS = ("org_id", "app_version_id", "target", "status")
+
+class MemoryStore(JobStore):
+    """Keeps nothing beyond the queue's own dicts, except indexes for listing the jobs in them."""
+
+    def __init__(self):
+        # (field, value) -> ascending seqs of the jobs with that value, kept up to date on every
+        # write. A listing walks back from its cursor through its most selective filter and
+        # stops after limit matches, rather than looking at every job
+        self._index: Dict[Tuple[str, str], List[int]] = {}
+        self._seqs: List[int] = []
+        self._job_ids: Dict[int, str] = {}
+        # job_id -> (seq, {field: value}, payload), to find a job's index entries again
+        self._jobs: Dict[str, Tuple[int, Dict[str, str], JobPayload]] = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def add_jobs(self, jobs):
+        with self._lock:
+            for job_id, job, _, status, _ in jobs:
+                self._seq += 1
+                fields = {"org_id": job.org_id, "app_version_id": job.app_version_id, "target": job.target, "status": status}
+                self._jobs[job_id] = (self._seq, fields, job)
+                self._job_ids[self._seq] = job_id
+                # Seqs only grow, so appending keeps every list sorted
+                self._seqs.append(self._seq)
+                for field, value in fields.items():
+                    self._index.setdefault((field, value), []).append(self._seq)
+
+    def update_status(self, job_id, status, message, result):
+        with self._lock:
+            entry = self._jobs.get(job_id)
+            if entry is None or entry[1]["status"] == status:
+                return
+            seq, fields, _ = entry
+            self._unindex(seq, "status", fields["status"])
+            fields["status"] = status
+            insort(self._index.setdefault(("status", status), []), seq)
+
+    def _unindex(self, seq: int, field: str, value: str):
+        # Caller must hold _lock
+        seqs = self._index[(field, value)]
+        del seqs[bisect_left(seqs, seq)]
+        if not seqs:
+            del self._index[(field, value)]
+
+    def forget(self, job_id):
+        with self._lock:
+            entry = self._jobs.pop(job_id, None)
+            if entry is not None:
+                seq, fields, _ = entry
+                del self._seqs[bisect_left(self._seqs, seq)]
+                del self._job_ids[seq]
+                for field, value in fields.items():
+                    self._unindex(seq, field, value)
+
+    def list_jobs(self, filters, before=None, limit=100):
+        matches = []
+        with self._lock:
+            if filters:
+                seqs = min((self._index.get((field, value), []) for field, value in filters.items()), key=len)
+            else:
+                seqs = self._seqs
+            end = len(seqs) if before is None else bisect_left(seqs, before)
+            for i in range(end - 1, -1, -1):
+                job_id = self._job_ids[seqs[i]]
+                fields = self._jobs[job_id][1]
+                if all(fields[field] == value for field, value in filters.items()):
+                    # Messages aren't kept here; the queue has them
+                    matches.append((seqs[i], job_id, fields["status"], None))
+                    if len(matches) == limit:
+                        break
+        return matches
+
+    def load_status(self, job_id):
+        return None
+
+    def load_result(self, job_id):
+        return None
+
+    def load_payload(self, job_id):
+        entry = self._jobs.get(job_id)
+        return entry[2] if entry else None
+
+    def load_unfinished(self):
+        return []
+
+class SQLiteStore(JobStore):
+    """SQLite in WAL mode. Writes are queued and committed in batches by a single writer thread.
+
+    Reads see queued writes too, so a result is readable as soon as update_status returns.
+    """
+
+    keeps_results = True
+
+    def __init__(self, path: str = DB_PATH, flush_interval: float = FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._inserts: List[tuple] = []
+        self._updates: Dict[str, tuple] = {}  # job_id -> latest status row; older updates are superseded
+        self._writing_updates: Dict[str, tuple] = {}  # the batch being committed right now
+        self._writing = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                submitted_at REAL NOT NULL,
+                status TEXT NOT NULL,
+                message TEXT,
+                result TEXT
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status_idx ON jobs (status);
+        """)
+        # Listing columns, copied out of the payload so they can be indexed. Databases from
+        # before they existed get them added and filled in
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        with conn:
+            for field in ("org_id", "app_version_id", "target"):
+                if field not in columns:
+                    try:
+                        conn.execute(f"ALTER TABLE jobs ADD COLUMN {field} TEXT")
+                        conn.execute(f"UPDATE jobs SET {field} = json_extract(payload, '$.{field}')")
+                    except sqlite3.OperationalError:
+                        pass  # added by another API worker opening the database at the same time
+                # Index entries are ordered by rowid within a value, so a filtered page is a range scan
+                conn.execute(f"CREATE INDEX IF NOT EXISTS jobs_{field}_idx ON jobs ({field})")
+        conn.close()
+
+        self._writer = threading.Thread(target=self._write_loop, name="store-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        # One read connection per thread; WAL lets them read while the writer commits
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _queue_writes(self, inserts: List[tuple], updates: List[tuple]):
+        # Only the first write of a batch (or a full batch) wakes the writer, so the
+        # flush interval isn't cut short by every submit
+        with self._cond:
+            was_empty = not (self._inserts or self._updates)
+            self._inserts.extend(inserts)
+            for row in updates:
+                self._updates[row[-1]] = row
+            if was_empty or len(self._inserts) + len(self._updates) >= MAX_BATCH:
+                self._cond.notify_all()
+
+    def add_jobs(self, jobs):
+        rows = [(job_id, job.model_dump_json(), submitted_at, status, message, job.org_id, job.app_version_id, job.target)
+                for job_id, job, submitted_at, status, message in jobs]
+        self._queue_writes(rows, [])
+
+    def update_status(self, job_id, status, message, result):
+        row = (status, message, json.dumps(result) if result is not None else None, job_id)
+        self._queue_writes([], [row])
+
+    def _pending_row(self, job_id: str) -> Optional[tuple]:
+        with self._cond:
+            return self._updates.get(job_id) or self._writing_updates.get(job_id)
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            with self._cond:
+                while not (self._inserts or self._updates or self._closed):
+                    self._cond.wait()
+                if not self._closed and len(self._inserts) + len(self._updates) < MAX_BATCH:
+                    # Let concurrent submitters join this commit
+                    self._cond.wait(self.flush_interval)
+                inserts, self._inserts = self._inserts, []
+                updates, self._updates = self._updates, {}
+                if not (inserts or updates) and self._closed:
+                    break
+                self._writing = True
+                self._writing_updates = updates
+            failed = False
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO jobs (job_id, payload, submitted_at, status, message, org_id, app_version_id, target)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        inserts,
+                    )
+                    conn.executemany("UPDATE jobs SET status = ?, message = ?, result = ? WHERE job_id = ?", updates.values())
+            except Exception as e:
+                print(f"Committing {len(inserts)} jobs and {len(updates)} status updates to {self.path} failed: {e}")
+                failed = True
+            with self._cond:
+                if failed and not self._closed:
+                    # Put the batch back ahead of what was queued meanwhile; newer updates still win
+                    self._inserts[:0] = inserts
+                    self._updates = {**updates, **self._updates}
+                self._writing = False
+                self._writing_updates = {}
+                self._cond.notify_all()
+            if failed:
+                if self._closed:
+                    break
+                time.sleep(WRITE_RETRY_INTERVAL)
+        conn.close()
+
+    def flush(self):
+        """Block until every queued write has been committed (retrying failed commits until they succeed)."""
+        with self._cond:
+            self._cond.notify_all()
+            while self._inserts or self._updates or self._writing:
+                self._cond.wait()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
+
+    def load_status(self, job_id):
+        row = self._pending_row(job_id)
+        if row is None:
+            row = self._reader().execute(
+                "SELECT status, message, result, job_id FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        status, message, result, _ = row
+        return JobStatus(job_id=job_id, status=status, message=message, result=json.loads(result) if result else None)
+
+    def load_result(self, job_id):
+        pending = self._pending_row(job_id)
+        if pending is not None:
+            result = pending[2]
+        else:
+            row = self._reader().execute("SELECT result FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            result = row[0] if row else None
+        return json.loads(result) if result else None
+
+    def load_payload(self, job_id):
+        row = self._reader().execute("SELECT payload FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            # Possibly not committed yet
+            self.flush()
+            row = self._reader().execute("SELECT payload FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return JobPayload.model_validate_json(row[0]) if row else None
+
+    def load_unfinished(self):
+        rows = self._reader().execute(
+            "SELECT job_id, payload, submitted_at, status FROM jobs WHERE status IN ('queued', 'running') ORDER BY rowid"
+        ).fetchall()
+        return [(job_id, JobPayload.model_validate_json(payload), submitted_at, status)
+                for job_id, payload, submitted_at, status in rows]
+
+    def list_jobs(self, filters, before=None, limit=100):
+        # Doesn't flush, so listing doesn't cut group commits short; the queue has fresher statuses
+        where = [f"{field} = ?" for field in filters]
+        params = list(filters.values())
+        if before is not None:
+            where.append("rowid < ?")
+            params.append(before)
+        sql = "SELECT rowid, job_id, status, message FROM jobs"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return self._reader().execute(sql + " ORDER BY rowid DESC LIMIT ?", (*params, limit)).fetchall()
+
+def open_store(backend: str = STORE_BACKEND) -> JobStore:
+    if backend == "memory":
+        return MemoryStore()
+    if backend == "sqlite":
+        return SQLiteStore()
+    raise ValueError(f"Unknown job store backend: {backend}")
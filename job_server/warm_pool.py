@@ -0,0 +1,176 @@
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List, Optional, Set
+from job_server import metrics
+from job_server.runner import LOG_DIR, TAIL_BYTES, get_loop
+
+# Number of pre-launched Node runners (warm_runner.js); 0 keeps spawning `npx playwright` per run
+WARM_RUNNERS = int(os.environ.get("QGJOB_WARM_RUNNERS", "0"))
+# A runner is replaced after this many runs or once it and its browser use more memory than this
+WARM_RUNNER_MAX_RUNS = int(os.environ.get("QGJOB_WARM_RUNNER_MAX_RUNS", "50"))
+WARM_RUNNER_MAX_RSS_MB = float(os.environ.get("QGJOB_WARM_RUNNER_MAX_RSS_MB", "1024"))
+WARM_RUNNER_START_TIMEOUT = float(os.environ.get("QGJOB_WARM_RUNNER_START_TIMEOUT", "60"))
+NODE_PATH = os.environ.get("QGJOB_NODE_PATH", "node")
+RUNNER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "warm_runner.js")
+
+class WarmRunner:
+    """One warm_runner.js process: a browser server plus a resolved Playwright CLI."""
+
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+        self.runs = 0
+        self.rss = 0
+        self.run_id: Optional[str] = None
+        # Set once it has been told to shut down; it may still report its last run's exit
+        self.retired = False
+
+    async def _read_message(self, timeout: float) -> dict:
+        line = await asyncio.wait_for(self.process.stdout.readline(), timeout)
+        if not line:
+            raise RuntimeError(f"warm runner exited with code {await self.process.wait()}")
+        message = json.loads(line)
+        self.rss = message.get("rss", self.rss)
+        return message
+
+    async def run(self, run_id: str, args: List[str], log_path: str, timeout: float,
+                  env: Optional[Dict[str, str]] = None) -> int:
+        request = {"run_id": run_id, "args": args, "log_path": os.path.abspath(log_path), "env": env or {}}
+        # Set before the first await, so _kill finds the run from the moment it is handed over
+        self.run_id = run_id
+        try:
+            self.process.stdin.write(json.dumps(request).encode() + b"\n")
+            await self.process.stdin.drain()
+            self.runs += 1
+            return (await self._read_message(timeout))["exit_code"]
+        finally:
+            self.run_id = None
+
+    def worn_out(self) -> bool:
+        return self.runs >= WARM_RUNNER_MAX_RUNS or self.rss > WARM_RUNNER_MAX_RSS_MB * 2**20
+
+    async def stop(self):
+        # EOF makes the runner kill its current run and close the browser; kill it if that hangs
+        if self.process.returncode is None:
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), 5)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+
+async def start_runner() -> WarmRunner:
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        NODE_PATH, RUNNER_SCRIPT, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+    )
+    runner = WarmRunner(process)
+    try:
+        await runner._read_message(WARM_RUNNER_START_TIMEOUT)
+    except BaseException:
+        await runner.stop()
+        raise
+    metrics.spawn_time.observe(time.perf_counter() - started)
+    return runner
+
+class WarmPool:
+    """Up to size runners, started on first use and recycled when worn out. Lives on the runner loop."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.started = 0
+        self.idle: List[WarmRunner] = []
+        self.busy: List[WarmRunner] = []
+        self.available = asyncio.Condition()
+
+    async def acquire(self) -> WarmRunner:
+        async with self.available:
+            while not self.idle and self.started >= self.size:
+                await self.available.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.started += 1
+        try:
+            return await start_runner()
+        except BaseException:
+            await self._forget()
+            raise
+
+    async def release(self, runner: WarmRunner, healthy: bool):
+        if healthy and not runner.retired and not runner.worn_out():
+            async with self.available:
+                self.idle.append(runner)
+                self.available.notify()
+            return
+        # Replaced lazily: the next acquire starts a fresh runner in its place
+        await runner.stop()
+        await self._forget()
+
+    async def _forget(self):
+        async with self.available:
+            self.started -= 1
+            self.available.notify()
+
+    async def run_command(self, run_id: str, args: List[str], log_path: str, timeout: float,
+                          env: Optional[Dict[str, str]] = None) -> dict:
+        os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+        runner = await self.acquire()
+        if run_id in _pending_kills:
+            # Killed while waiting for a runner: don't start it at all
+            _pending_kills.discard(run_id)
+            await self.release(runner, True)
+            raise RuntimeError("killed before it started")
+        self.busy.append(runner)
+        healthy = False
+        try:
+            exit_code = await runner.run(run_id, args, log_path, timeout, env)
+            healthy = True
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"timed out after {timeout} seconds")
+        finally:
+            # A run that timed out or lost its runner takes the runner (and its process tree) down with it
+            self.busy.remove(runner)
+            _pending_kills.discard(run_id)
+            await self.release(runner, healthy)
+        # The runner writes stdout and stderr to the same log, so the tail is reported as stdout
+        return {"stdout": _read_tail(log_path), "stderr": "", "exit_code": exit_code, "log_path": log_path}
+
+def _read_tail(path: str, max_bytes: int = TAIL_BYTES) -> str:
+    with open(path, "rb") as log_file:
+        log_file.seek(max(0, os.path.getsize(path) - max_bytes))
+        return log_file.read().decode("utf-8", errors="replace")
+
+_pool: Optional[WarmPool] = None
+# Runs killed before they got a runner. Only touched on the runner loop
+_pending_kills: Set[str] = set()
+
+async def _run_command(run_id: str, args: List[str], log_path: str, timeout: float,
+                       env: Optional[Dict[str, str]] = None) -> dict:
+    global _pool
+    if _pool is None:
+        _pool = WarmPool(WARM_RUNNERS)
+    return await _pool.run_command(run_id, args, log_path, timeout, env)
+
+def _kill(run_id: str):
+    for runner in _pool.busy if _pool else ():
+        if runner.run_id == run_id:
+            if runner.process.returncode is None:
+                # EOF: the runner kills the run's process group and exits. It may still report the
+                # killed run's exit first, so it is retired to keep release() from reusing it
+                runner.retired = True
+                runner.process.stdin.close()
+            return
+    # Still waiting for a runner (or not submitted to the loop yet)
+    _pending_kills.add(run_id)
+
+def kill_warm_job(run_id: str):
+    """Stop a run started by run_warm_job, along with the runner it is on. A run still waiting
+    for a runner is dropped once it gets one."""
+    get_loop().call_soon_threadsafe(_kill, run_id)
+
+def run_warm_job(run_id: str, args: List[str], timeout: float, env: Optional[Dict[str, str]] = None) -> dict:
+    """Like runner.run_job for `playwright <args>`, but on a warm runner from the pool."""
+    log_path = os.path.join(LOG_DIR, f"{run_id}.log")
+    future = asyncio.run_coroutine_threadsafe(_run_command(run_id, args, log_path, timeout, env), get_loop())
+    return future.result()
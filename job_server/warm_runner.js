@@ -0,0 +1,80 @@
+// Long-lived Playwright runner used by job_server/warm_pool.py.
+//
+// Resolves the Playwright CLI and launches a browser server once, then reads one JSON
+// request per line on stdin: {"run_id", "args", "log_path", "env"}. Each request runs
+// `playwright <args>` against the already running browser (PW_TEST_CONNECT_WS_ENDPOINT),
+// with output written straight to log_path, and answers with one JSON line on stdout:
+// {"run_id", "exit_code", "rss"}. Closing stdin stops the current run and the browser.
+const { spawn } = require("child_process");
+const fs = require("fs");
+const readline = require("readline");
+
+const cwd = process.cwd();
+const cli = require.resolve("@playwright/test/cli", { paths: [cwd] });
+const playwright = require(require.resolve("@playwright/test", { paths: [cwd] }));
+const browserType = playwright[process.env.QGJOB_WARM_BROWSER || "chromium"];
+
+let server = null;
+let current = null;
+
+function send(message) {
+  process.stdout.write(JSON.stringify(message) + "\n");
+}
+
+function rssBytes() {
+  // Worker plus browser; the browser is what grows over many runs
+  let rss = process.memoryUsage().rss;
+  try {
+    const status = fs.readFileSync(`/proc/${server.process().pid}/status`, "utf8");
+    const match = /VmRSS:\s+(\d+) kB/.exec(status);
+    if (match) rss += Number(match[1]) * 1024;
+  } catch (e) {
+    // No procfs (Windows, macOS): only the worker is counted
+  }
+  return rss;
+}
+
+function killCurrent() {
+  if (current && current.exitCode === null) {
+    try {
+      // Negative PID: the run's whole process group, including Playwright's own workers
+      process.kill(process.platform === "win32" ? current.pid : -current.pid, "SIGKILL");
+    } catch (e) {
+      current.kill("SIGKILL");
+    }
+  }
+}
+
+function run(request) {
+  const log = fs.openSync(request.log_path, "w");
+  current = spawn(process.execPath, [cli, ...request.args], {
+    cwd,
+    env: { ...process.env, ...(request.env || {}), PW_TEST_CONNECT_WS_ENDPOINT: server.wsEndpoint() },
+    stdio: ["ignore", log, log],
+    detached: process.platform !== "win32",
+  });
+  current.on("exit", (code, signal) => {
+    fs.closeSync(log);
+    current = null;
+    send({ run_id: request.run_id, exit_code: code === null ? -1 : code, signal, rss: rssBytes() });
+  });
+}
+
+async function shutdown() {
+  killCurrent();
+  if (server) await server.close().catch(() => {});
+  process.exit(0);
+}
+
+async function main() {
+  server = await browserType.launchServer({ headless: process.env.QGJOB_WARM_HEADLESS === "1" });
+  send({ ready: true, ws_endpoint: server.wsEndpoint(), rss: rssBytes() });
+  const lines = readline.createInterface({ input: process.stdin });
+  lines.on("line", (line) => run(JSON.parse(line)));
+  lines.on("close", shutdown);
+}
+
+main().catch((error) => {
+  process.stderr.write(`${error.stack || error}\n`);
+  process.exit(1);
+});
@@ -1,4 +1,5 @@
 import click
+import glob
 import json
 from . import rest_client
 
@@ -13,28 +14,166 @@ def cli():
 @click.option('--test', 'test_path', required=True, help='Path to test script')
 @click.option('--priority', default=1, show_default=True, help='Job priority (higher = more urgent)')
 @click.option('--target', type=click.Choice(['emulator', 'device', 'browserstack']), required=True, help='Target environment')
-def submit(org_id, app_version_id, test_path, priority, target):
+@click.option('--use-cache', is_flag=True, help='Reuse the result of an identical run (same app version, target, test and config)')
+@click.option('--shards', default=1, show_default=True, type=click.IntRange(min=1), help='Split the test run into this many parallel Playwright shards')
+@click.option('--deadline', type=float, help='Cancel the job if it has not finished this many seconds after submission')
+@click.option('--branch', help='Branch the app build was made from')
+@click.option('--supersede', is_flag=True, help="Cancel queued jobs for the org's other builds of --branch")
+def submit(org_id, app_version_id, test_path, priority, target, use_cache, shards, deadline, branch, supersede):
     """Submit a test job."""
     payload = {
         'org_id': org_id,
         'app_version_id': app_version_id,
         'test_path': test_path,
         'priority': priority,
-        'target': target
+        'target': target,
+        'use_cache': use_cache,
+        'shards': shards,
+        'deadline': deadline,
+        'branch': branch,
+        'supersede': supersede
     }
     click.echo(f"Submitting job: {payload}")
     result = rest_client.submit_job(payload)
     click.echo(f"Job submitted. Job ID: {result.get('job_id')}")
 
+@cli.command('submit-batch')
+@click.option('--manifest', type=click.File('r'), help='JSON file with a list of job objects (fields default to the options below)')
+@click.option('--tests', 'test_globs', multiple=True, help='Glob of test scripts to submit, e.g. "tests/**/*.spec.js" (repeatable)')
+@click.option('--org-id', help='Organization ID')
+@click.option('--app-version-id', help='App version ID')
+@click.option('--priority', default=1, show_default=True, help='Job priority (higher = more urgent)')
+@click.option('--target', type=click.Choice(['emulator', 'device', 'browserstack']), help='Target environment')
+@click.option('--use-cache', is_flag=True, help='Reuse the result of an identical run (same app version, target, test and config)')
+def submit_batch(manifest, test_globs, org_id, app_version_id, priority, target, use_cache):
+    """Submit many test jobs in a single request."""
+    defaults = {
+        'org_id': org_id,
+        'app_version_id': app_version_id,
+        'priority': priority,
+        'target': target,
+        'use_cache': use_cache
+    }
+    entries = json.load(manifest) if manifest else []
+    for pattern in test_globs:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            raise click.UsageError(f"No test scripts match {pattern!r}")
+        entries.extend({'test_path': path} for path in matches)
+    if not entries:
+        raise click.UsageError("Nothing to submit: pass --manifest and/or --tests")
+
+    payloads = []
+    for entry in entries:
+        payload = {**defaults, **entry}
+        missing = [key for key in ('org_id', 'app_version_id', 'test_path', 'target') if not payload.get(key)]
+        if missing:
+            raise click.UsageError(f"Job {entry} is missing {', '.join(missing)}")
+        payloads.append(payload)
+
+    click.echo(f"Submitting {len(payloads)} jobs")
+    result = rest_client.submit_jobs(payloads)
+    for payload, job_id in zip(payloads, result.get('job_ids', [])):
+        click.echo(f"{job_id} {payload['test_path']}")
+
+def exit_code_for(status):
+    """Process exit code for a finished job: 0 if it completed, else its test exit code (or 1)."""
+    if status.get("status") == "completed":
+        return 0
+    exit_code = (status.get("result") or {}).get("exit_code")
+    return exit_code if isinstance(exit_code, int) and exit_code > 0 else 1
+
+def wait_for_jobs(job_ids, echo_updates):
+    """Block on the server's status stream until every job has finished; return the final statuses."""
+    final = {}
+    for status in rest_client.stream_job_statuses(job_ids):
+        final[status["job_id"]] = status
+        if echo_updates:
+            click.echo(json.dumps(status))
+    return [final[job_id] for job_id in job_ids if job_id in final]
+
 @cli.command()
 @click.option('--job-id', required=True, help='Job ID to check status')
-def status(job_id):
+@click.option('--wait', is_flag=True, help='Block until the job finishes and exit with its result code')
+def status(job_id, wait):
     """Check the status of a job."""
     try:
+        if wait:
+            final = wait_for_jobs([job_id], echo_updates=False)
+            click.echo(json.dumps(final[0]))
+            raise SystemExit(exit_code_for(final[0]))
         result = rest_client.get_job_status(job_id)
         click.echo(json.dumps(result))
     except Exception as e:
         click.echo(json.dumps({"status": "error", "message": str(e)}))
+        if wait:
+            raise SystemExit(1)
+
+@cli.command()
+@click.option('--job-id', 'job_ids', required=True, multiple=True, help='Job ID to wait for (repeatable)')
+def wait(job_ids):
+    """Stream status changes until every job finishes; exit non-zero if any did not complete."""
+    try:
+        final = wait_for_jobs(list(job_ids), echo_updates=True)
+    except Exception as e:
+        click.echo(json.dumps({"status": "error", "message": str(e)}))
+        raise SystemExit(1)
+    codes = [exit_code_for(status) for status in final]
+    raise SystemExit(next((code for code in codes if code), 0))
+
+@cli.command('list')
+@click.option('--org-id', help='Only jobs of this organization')
+@click.option('--app-version-id', help='Only jobs for this app version')
+@click.option('--target', type=click.Choice(['emulator', 'device', 'browserstack']), help='Only jobs for this target')
+@click.option('--status', type=click.Choice(['queued', 'running', 'completed', 'failed', 'cancelled']), help='Only jobs in this state')
+@click.option('--limit', default=50, show_default=True, type=click.IntRange(1, 1000), help='Jobs per page')
+@click.option('--cursor', type=int, help='Continue from the next_cursor of an earlier page')
+@click.option('--all', 'all_pages', is_flag=True, help='Keep fetching pages until every matching job is listed')
+def list_jobs(org_id, app_version_id, target, status, limit, cursor, all_pages):
+    """List jobs, newest first, one JSON object per line."""
+    filters = {"org_id": org_id, "app_version_id": app_version_id, "target": target, "status": status}
+    try:
+        while True:
+            page = rest_client.list_jobs(filters, cursor, limit)
+            for job in page["jobs"]:
+                click.echo(json.dumps(job))
+            cursor = page["next_cursor"]
+            if cursor is None or not all_pages:
+                break
+    except Exception as e:
+        click.echo(json.dumps({"status": "error", "message": str(e)}))
+        raise SystemExit(1)
+    if cursor is not None:
+        click.echo(f"More jobs: --cursor={cursor}", err=True)
+
+@cli.command()
+@click.option('--job-id', required=True, help='Finished job whose failed tests to rerun')
+@click.option('--wait', is_flag=True, help='Block until the retry finishes and exit with its result code')
+def retry(job_id, wait):
+    """Rerun only the tests that failed in a job, as a new job."""
+    response = rest_client.retry_failed_tests(job_id)
+    if not response.ok:
+        click.echo(json.dumps({"job_id": job_id, "status": "error", "message": response.json().get("detail")}))
+        raise SystemExit(1)
+    click.echo(json.dumps(response.json()))
+    if wait:
+        final = wait_for_jobs([response.json()["job_id"]], echo_updates=False)
+        click.echo(json.dumps(final[0]))
+        raise SystemExit(exit_code_for(final[0]))
+
+@cli.command()
+@click.option('--job-id', 'job_ids', required=True, multiple=True, help='Job ID to cancel (repeatable)')
+def cancel(job_ids):
+    """Cancel jobs: queued jobs never run, running ones are stopped and free their slot."""
+    failed = False
+    for job_id in job_ids:
+        response = rest_client.cancel_job(job_id)
+        if response.ok:
+            click.echo(json.dumps(response.json()))
+        else:
+            failed = True
+            click.echo(json.dumps({"job_id": job_id, "status": "error", "message": response.json().get("detail")}))
+    raise SystemExit(1 if failed else 0)
 
 if __name__ == "__main__":
     cli() 
\ No newline at end of file
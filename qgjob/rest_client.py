@@ -1,13 +1,47 @@
+import json
 import requests
 
 API_BASE_URL = "http://localhost:8000"  # Change as needed
 
+# Reuse one connection for every request made by this process
+_session = requests.Session()
+
 def submit_job(payload):
-    # Stub: Replace with actual POST request
-    response = requests.post(f"{API_BASE_URL}/jobs", json=payload)
+    response = _session.post(f"{API_BASE_URL}/jobs", json=payload)
+    return response.json()
+
+def submit_jobs(payloads):
+    # All jobs are enqueued by a single POST
+    response = _session.post(f"{API_BASE_URL}/jobs:batch", json=payloads)
+    response.raise_for_status()
     return response.json()
 
 def get_job_status(job_id):
-    # Stub: Replace with actual GET request
-    response = requests.get(f"{API_BASE_URL}/jobs/{job_id}")
-    return response.json() 
\ No newline at end of file
+    response = _session.get(f"{API_BASE_URL}/jobs/{job_id}")
+    return response.json()
+
+def list_jobs(filters, cursor=None, limit=100):
+    # filters: org_id, status, app_version_id and/or target
+    params = {**{k: v for k, v in filters.items() if v is not None}, "limit": limit}
+    if cursor is not None:
+        params["cursor"] = cursor
+    response = _session.get(f"{API_BASE_URL}/jobs", params=params)
+    response.raise_for_status()
+    return response.json()
+
+def retry_failed_tests(job_id):
+    # Returns the response so callers can tell why there was nothing to retry
+    return _session.post(f"{API_BASE_URL}/jobs/{job_id}/retry")
+
+def cancel_job(job_id):
+    # Returns the response so callers can tell "cancelled" from "not found" or "already finished"
+    return _session.delete(f"{API_BASE_URL}/jobs/{job_id}")
+
+def stream_job_statuses(job_ids):
+    """Yield each status pushed by the server (server-sent events) until every job has finished."""
+    # The server sends a keepalive well within the read timeout
+    with _session.get(f"{API_BASE_URL}/jobs:events", params={"job_id": job_ids}, stream=True, timeout=(10, 60)) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            if line and line.startswith("data:"):
+                yield json.loads(line[len("data:"):])
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Stress test for the job queue
+Submits jobs from many threads into a handful of groups while scheduler workers and
+leasing agents drain them, so jobs keep landing in groups that are being run. Checks
+that every job runs exactly once and finishes. Runs in-process with a stubbed runner,
+so neither a live server nor Playwright is needed.
+"""
+import os
+import random
+import threading
+import time
+from collections import Counter
+
+os.environ.setdefault("QGJOB_STORE", "memory")
+# Keep every finished job in memory so all of them can be checked at the end
+os.environ.setdefault("QGJOB_RETAIN_FINISHED_JOBS", "1000000")
+
+from job_server import leases, queue, scheduler
+from job_server.models import JobPayload
+
+SUBMITTERS = 8
+JOBS_PER_SUBMITTER = 1500
+GROUPS = 5
+AGENTS = 2
+
+runs = Counter()
+runs_lock = threading.Lock()
+
+def stub_run_group(group_key, jobs, report=queue.update_job_status):
+    """Count each run, give other threads a chance to submit into the group, complete the job"""
+    # Takes the job list up front, as group execution does
+    for job_id, job in list(jobs):
+        with runs_lock:
+            runs[job_id] += 1
+        report(job_id, "running")
+        time.sleep(0)
+        report(job_id, "completed")
+
+def submitter(seed, job_ids):
+    rng = random.Random(seed)
+    for i in range(JOBS_PER_SUBMITTER):
+        job = JobPayload(
+            org_id=f"org_{rng.randrange(2)}",
+            app_version_id=f"app_{rng.randrange(GROUPS)}",
+            test_path=f"tests/spec_{i}.spec.js",
+            target="emulator",
+            priority=rng.randint(1, 3),
+        )
+        if rng.random() < 0.2:
+            job_ids.extend(queue.enqueue_jobs([job, job]))
+        else:
+            job_ids.append(queue.enqueue_job(job))
+
+def agent_loop(agent_id, stop):
+    # Leases groups like a standalone agent, half the time handing them back unfinished
+    rng = random.Random(agent_id)
+    while not stop.is_set():
+        lease = leases.acquire(agent_id, wait=0.05)
+        if lease is None:
+            continue
+        if rng.random() < 0.5:
+            stub_run_group(lease.group_key, lease.jobs)
+        leases.complete(agent_id, lease.lease_id, [])
+
+def main():
+    print("🧵 Queue Stress Test")
+    print("=" * 40)
+    queue.reset_queue()
+    queue.TARGET_SLOTS["emulator"] = 4
+    scheduler.run_group = stub_run_group
+    scheduler.start_scheduler(3)
+    stop = threading.Event()
+    agents = [threading.Thread(target=agent_loop, args=(f"agent-{i}", stop)) for i in range(AGENTS)]
+    for t in agents:
+        t.start()
+
+    started = time.perf_counter()
+    job_lists = [[] for _ in range(SUBMITTERS)]
+    submitters = [threading.Thread(target=submitter, args=(i, job_lists[i])) for i in range(SUBMITTERS)]
+    for t in submitters:
+        t.start()
+    for t in submitters:
+        t.join()
+    job_ids = [job_id for job_list in job_lists for job_id in job_list]
+    print(f"📤 Submitted {len(job_ids)} jobs from {SUBMITTERS} threads in {time.perf_counter() - started:.2f}s")
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if all(queue.get_job_status(job_id).status == "completed" for job_id in job_ids):
+            break
+        time.sleep(0.1)
+    stop.set()
+    for t in agents:
+        t.join()
+    scheduler.stop_scheduler()
+
+    unfinished = [job_id for job_id in job_ids if queue.get_job_status(job_id).status != "completed"]
+    never_ran = [job_id for job_id in job_ids if runs[job_id] == 0]
+    ran_twice = [job_id for job_id in job_ids if runs[job_id] > 1]
+    print(f"⏱️  Drained in {time.perf_counter() - started:.2f}s")
+    print(f"{'✅' if not unfinished else '❌'} Unfinished jobs: {len(unfinished)}")
+    print(f"{'✅' if not never_ran else '❌'} Jobs that never ran: {len(never_ran)}")
+    print(f"{'✅' if not ran_twice else '❌'} Jobs that ran more than once: {len(ran_twice)}")
+    print(f"{'✅' if not queue.active_groups and not any(queue.busy_slots.values()) else '❌'} All slots released")
+    if unfinished or never_ran or ran_twice:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()